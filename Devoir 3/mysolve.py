@@ -1,4 +1,7 @@
 import numpy as np
+import scipy.sparse
+import hashlib
+import collections
 
 # The function mysolve(A, b) is invoked by ndt.py
 # to solve the linear system
@@ -10,48 +13,198 @@ SolverType = 'LUcsr-rcmk'
 tol = 1e-15
 
 def mysolve(A, b):
+    # b can hold several right members (one per column) : the matrix is then factorized only once
     if SolverType == 'numpy':
         return True, np.linalg.solve(np.array(A), np.array(b))
-    elif SolverType == 'LU':
-        LUres, P = LU(A)
-        return True, LUsolve(LUres, b, P)
-    elif SolverType == 'LUcsr-rcmk':
-        sA, iA, jA = CSRformat(A)
-        r = RCMK(iA, jA)
-        r_inv = invert_r(r)
-        sA, iA, jA = reduce_bands(sA, iA, jA, r, r_inv)
-        sLU, iLU, jLU = LUcsr(sA, iA, jA)
-        return True, LUsolve_csr(sLU, iLU, jLU, b[r])[r_inv]
-    elif SolverType == 'LUcsr':
-        sA, iA, jA = CSRformat(A)
-        sLU, iLU, jLU = LUcsr(sA, iA, jA)
-        return True, LUsolve_csr(sLU, iLU, jLU, b)
+    elif SolverType in ('LU', 'LUcsr-rcmk', 'LUcsr'):
+        factor = factorize(A, SolverType)
+        if factor is None:
+            return False, 0
+        return True, factor.solve(b)
     elif SolverType == 'GMRES':
         return False, 0
     else:
         return False, 0
 
 
+# ============= FACTORIZATIONS =============
+
+# Factorizations computed by mysolve, keyed by the method and the matrix (structure and values),
+# the least recently used first. Solving again with the same matrix does not factorize it again.
+factorizations = collections.OrderedDict()
+FACTOR_CACHE_SIZE = 4
+
+# Symbolic analyses of the LU decomposition in CSR format (see LUcsr_symbolic), keyed by the method and the sparsity
+# pattern : a matrix with new values but the same pattern (another freq, vel or mur) only needs the numeric phase.
+patterns = collections.OrderedDict()
+PATTERN_CACHE_SIZE = 4
+
+
+class LUFactor:
+    """
+    LU decomposition with partial pivoting of a full matrix A (result of LU(A)).
+    """
+    def __init__(self, A):
+        self.N = len(A)
+        self.LU, self.P = LU(A)
+        self.singular = self.LU is None
+
+    def solve(self, b):
+        """
+        :param b: numpy 1D (or 2D, one right member per column) array
+        :return: the solution x of Ax = b
+        """
+        return LUsolve(self.LU, b, self.P)
+
+
+class LUcsrFactor:
+    """
+    LU decomposition in CSR format of a matrix A given in CSR format (see LUcsr_symbolic and LUcsr_numeric).
+    If rcmk is True, the matrix is first permuted by the RCMK algorithm to reduce its bands : LU is then the
+    decomposition of A[r, :][:, r] and the permutation vectors r and r_inv are kept to solve the system.
+    """
+    def __init__(self, sA, iA, jA, rcmk=True):
+        self.N = len(iA) - 1
+        symbolic = analyse(iA, jA, rcmk)
+        self.r, self.r_inv = symbolic['r'], symbolic['r_inv']
+        self.LU = LUcsr_numeric(sA, symbolic)
+        self.singular = self.LU is None
+        # the level scheduling of the triangular solves, shared by all the solves
+        self.levels = symbolic['levels']
+
+    def solve(self, b):
+        """
+        :param b: numpy 1D (or 2D, one right member per column) array
+        :return: the solution x of Ax = b
+        """
+        if self.r is None:
+            return LUsolve_csr_split(self.LU, b, self.levels)
+        return LUsolve_csr_split(self.LU, np.asarray(b)[self.r], self.levels)[self.r_inv]
+
+
+def matrix_key(method, *arrays):
+    """
+    Computes the key of a matrix in the cache of the factorizations : the method and a digest of the arrays
+    representing the matrix (its values and, for a sparse matrix, its structure).
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype, array.shape)).encode())
+        digest.update(array.tobytes())
+    return method, digest.hexdigest()
+
+
+def analyse(iA, jA, rcmk=True):
+    """
+    Returns the symbolic analysis of the LU decomposition in CSR format of a matrix with the sparsity pattern iA, jA,
+    from the cache if a matrix with the same pattern was already factorized.
+    :param iA, jA: the indices vectors of a matrix in CSR format
+    :param rcmk: boolean, if True the matrix is permuted by the RCMK algorithm
+    :return: the result of LUcsr_symbolic(iA, jA, rcmk)
+    """
+    key = matrix_key(rcmk, iA, jA)
+    if key in patterns:
+        patterns.move_to_end(key)
+        return patterns[key]
+
+    symbolic = LUcsr_symbolic(iA, jA, rcmk)
+    patterns[key] = symbolic
+    while len(patterns) > PATTERN_CACHE_SIZE:
+        patterns.popitem(last=False)
+    return symbolic
+
+
+def factorize(A, method='LUcsr-rcmk'):
+    """
+    Returns the factorization of the matrix A by the given method, from the cache if A was already factorized.
+    :param A: 2D numpy array (or matrix) or scipy sparse matrix
+    :param method: 'LU' (full matrices), 'LUcsr' or 'LUcsr-rcmk' (CSR format, with the RCMK permutation)
+    :return: a LUFactor or a LUcsrFactor, with a method solve(b). None if A is singular.
+    """
+    if method == 'LU':
+        if scipy.sparse.issparse(A):
+            A = A.toarray()
+        A = np.array(A)
+        key = matrix_key(method, A)
+    else:
+        sA, iA, jA = CSRformat(A)
+        key = matrix_key(method, sA, iA, jA)
+
+    if key in factorizations:
+        factorizations.move_to_end(key)
+        return factorizations[key]
+
+    factor = LUFactor(A) if method == 'LU' else LUcsrFactor(sA, iA, jA, rcmk=method == 'LUcsr-rcmk')
+    if factor.singular:
+        return None
+    factorizations[key] = factor
+    while len(factorizations) > FACTOR_CACHE_SIZE:
+        factorizations.popitem(last=False)
+    return factor
+
+
 # ============= CSR FUNCTIONS =============
 
 def CSRformat(A):
     """"
         Translates the matrix A in the CSR format.
-        @:param A: 2D numpy array (or matrix) to convert in CSR format
+        @:param A: 2D numpy array (or matrix) or scipy sparse matrix to convert in CSR format
         @:return: a tuple containing 3 1D numpy arrays:
             sA[s] contains the sth non-zero element of A
             iA[i] contains the index in sA containing the first non-zero element of the line i in A
             jA[j] contains the index of the column containing the jth non-zero element of A
     """
+    if scipy.sparse.issparse(A):
+        if A.format == 'csr' and A.has_canonical_format:
+            # Already sorted and without duplicates : its arrays are used as they are
+            return A.data, A.indptr.astype(int, copy=False), A.indices.astype(int, copy=False)
+        # A sparse matrix is never expanded : it is rebuilt from its triplets
+        A = scipy.sparse.coo_matrix(A)
+        return COOtoCSR(A.row, A.col, A.data, A.shape[0])
+
     A = np.array(A)
-    idx = np.nonzero(A)     # Gets the indices of non-zero elements in A
+    idx = np.nonzero(A)     # Gets the indices of non-zero elements in A (sorted by line, then by column)
     sA = A[idx]             # Storing non-zero elements in sA
     jA = idx[1]             # Storing the columns of the non-zero elements
 
+    # Counting the number of non-zero elements in each line
     iA = np.zeros(len(A)+1, dtype=int)
-    for i in range(1, len(iA)):
-        # Counting the number of non-zero elements in the ith line
-        iA[i] = iA[i-1] + np.sum(idx[0][iA[i-1]:] == i-1)
+    iA[1:] = np.cumsum(np.bincount(idx[0], minlength=len(A)))
+
+    return sA, iA, jA
+
+
+def COOtoCSR(rows, cols, vals, N):
+    """
+    Builds the CSR format of the N x N matrix given by its triplets (rows[k], cols[k], vals[k]), as produced by the
+    assembly, without any dense intermediate. Duplicate entries are summed and the columns of each line are sorted.
+    The cost is the one of sorting the triplets : O(nnz log nnz).
+    :param rows, cols: 1D numpy arrays of integers, line and column of each triplet
+    :param vals: 1D numpy array, value of each triplet. It can also be a 2D array (one column per matrix)
+                  to build at once several matrices sharing the same sparsity pattern, sA is then 2D as well.
+    :param N: integer, dimension of the matrix
+    :return: 3 1D numpy arrays sA, iA, jA representing the matrix in CSR format
+    """
+    rows = np.asarray(rows, dtype=int)
+    cols = np.asarray(cols, dtype=int)
+    vals = np.asarray(vals)
+    if len(vals) == 0:
+        return vals.copy(), np.zeros(N+1, dtype=int), np.zeros(0, dtype=int)
+
+    # Sorting the triplets by line then by column
+    key = rows * N + cols
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+
+    # Each group of equal keys is one entry of the CSR matrix, its duplicates are summed
+    first = np.concatenate(([True], key[1:] != key[:-1]))
+    start = np.nonzero(first)[0]
+    sA = np.add.reduceat(vals[order], start)
+    jA = key[start] % N
+
+    iA = np.zeros(N+1, dtype=int)
+    iA[1:] = np.cumsum(np.bincount(key[start] // N, minlength=N))
 
     return sA, iA, jA
 
@@ -118,14 +271,16 @@ def remove_zeros(sLU, iLU, jLU):
     return sLU, iLU, jLU
 
 
-def LUcsr(sA, iA, jA):
+def LUcsr(sA, iA, jA, split=False):
     """
     This function performs the LU algorithm with a sparse matrix and returns a sparse matrix in the form of 3 arrays
     but was vectorized
 
     :param sA, iA, jA: 3 1D numpy arrays representing a 2D matrix in CSR format
+    :param split: if True, the decomposition is returned split by split_LU
     :return: sLU, iLU, jLU: 3 1D numpy arrays representing the LU decomposition
-    (of the matrix represented by the parameters) in CSR format
+    (of the matrix represented by the parameters) in CSR format.
+    If split is True : the tuple (sL, iL, jL, sU, iU, jU, dinv) (see split_LU), None if A is singular.
     """
     N = len(iA) - 1
 
@@ -136,7 +291,7 @@ def LUcsr(sA, iA, jA):
     for i in range(N):
         a_ii = sLU[iLU[i] + i - jLU[iLU[i]]]
         if abs(a_ii) == 0:
-            return None, None, None
+            return None if split else (None, None, None)
         # Vectorized operations to divide column (inside band) by LU[i, i]
         # and update the sub-matrix (again, inside the band)
 
@@ -154,37 +309,204 @@ def LUcsr(sA, iA, jA):
         sLU[sub_matrix_indices] -= np.outer(sLU[column_indices], sLU[line_indices]).ravel()
 
     # Removes the remaining zeros and returns the sparse matrix representing LU
+    if split:
+        return split_LU(*remove_zeros(sLU, iLU, jLU))
     return remove_zeros(sLU, iLU, jLU)
 
 
+def LUcsr_symbolic(iA, jA, rcmk=True):
+    """
+    Symbolic phase of the LU decomposition in CSR format : everything that only depends on the sparsity pattern of
+    the matrix. It is computed once for all the matrices with this pattern (see analyse), LUcsr_numeric then only
+    computes the values.
+    The pattern of LU is the band of the (permuted) matrix, as in LUcsr, but its zeros are kept so that it does not
+    depend on the values.
+    :param iA, jA: the indices vectors of a matrix in CSR format
+    :param rcmk: boolean, if True the matrix is permuted by the RCMK algorithm to reduce its bands
+    :return: a dictionary with
+        r, r_inv: the RCMK permutation vectors (None if rcmk is False),
+        band_l, band_r: the bands of the (permuted) matrix,
+        iLU, jLU: the pattern of LU in CSR format,
+        place, source: the elements of A are put in sLU by sLU[place] = sA[source],
+        offset: the element (i, j) of LU is sLU[offset[i] + j],
+        lower, upper, diag: the indices in sLU of the elements of L, of U and of the diagonal,
+        iL, jL, iU, jU: the patterns of L and U in CSR format (see split_LU),
+        levels: the level scheduling of the triangular solves (see triangular_levels).
+    """
+    N = len(iA) - 1
+    M = len(jA)
+    r, r_inv = None, None
+    source = np.arange(M)
+    if rcmk:
+        r = RCMK(iA, jA)
+        r_inv = invert_r(r)
+        # the permuted matrix, its values being the indices of the elements in sA
+        rows = np.repeat(np.arange(N), np.diff(iA))
+        source, iA, jA = COOtoCSR(r_inv[rows], r_inv[jA], source, N)
+
+    band_l, band_r = compute_bands(iA, jA)
+    fill, iLU, jLU = create_fill_in(np.arange(1, M + 1), iA, jA, band_l, band_r)
+    place = np.nonzero(fill)[0]
+    source = source[fill[place].real.astype(int) - 1]
+    offset = iLU[:N] - jLU[iLU[:N]]
+
+    rows = np.repeat(np.arange(N), np.diff(iLU))
+    _, iL, jL, _, iU, jU, _ = split_LU(np.ones(len(jLU)), iLU, jLU)
+    return {'r': r, 'r_inv': r_inv, 'band_l': band_l, 'band_r': band_r, 'iLU': iLU, 'jLU': jLU,
+            'place': place, 'source': source, 'offset': offset,
+            'lower': np.nonzero(jLU < rows)[0], 'upper': np.nonzero(jLU > rows)[0], 'diag': offset + np.arange(N),
+            'iL': iL, 'jL': jL, 'iU': iU, 'jU': jU, 'levels': triangular_levels(iL, jL, iU, jU)}
+
+
+def LUcsr_numeric(sA, symbolic):
+    """
+    Numeric phase of the LU decomposition in CSR format (same algorithm as LUcsr).
+    All the elements of a step are in the band : their indices are computed from the offsets of the lines.
+    :param sA: 1D numpy array, the values of A in CSR format (not permuted)
+    :param symbolic: result of LUcsr_symbolic for the pattern of A
+    :return: the tuple (sL, iL, jL, sU, iU, jU, dinv) (see split_LU), None if A is singular.
+    """
+    offset = symbolic['offset']
+    band_l, band_r = symbolic['band_l'], symbolic['band_r']
+    N = len(offset)
+
+    sLU = np.zeros(len(symbolic['jLU']), dtype=complex)
+    sLU[symbolic['place']] = sA[symbolic['source']]
+
+    for i in range(N):
+        a_ii = sLU[offset[i] + i]
+        if abs(a_ii) == 0:
+            return None
+        # lines i+1 <= j < j_max and columns i+1 <= k < k_max of the band
+        lines = np.arange(i + 1, min(i + band_l + 1, N))
+        columns = np.arange(i + 1, min(i + band_r + 1, N))
+        column_indices = offset[lines] + i
+        line_indices = offset[i] + columns
+
+        sLU[column_indices] /= a_ii
+        sLU[(offset[lines][:, None] + columns).ravel()] -= np.outer(sLU[column_indices], sLU[line_indices]).ravel()
+
+    return (sLU[symbolic['lower']], symbolic['iL'], symbolic['jL'], sLU[symbolic['upper']], symbolic['iU'],
+            symbolic['jU'], 1 / sLU[symbolic['diag']])
+
+
 def LUsolve_csr(sLU, iLU, jLU, b):
     """
     Solves the two triangular systems Ly = b and Ux = y in sparse format and returns solution array x
     :param sLU, iLU, jLU: 3 numpy 1D arrays representing a LU decomposition in CSR format
                          of a matrix of dimension len(b) x len(b)
-    :param b: numpy 1D array, right member of the linear system to solve : LUx = b
-    :return: numpy 1D array representing the solution of the linear system
+    :param b: numpy 1D array, right member of the linear system to solve : LUx = b.
+               It can also be a 2D array of shape (len(b), k) : the k systems are solved at once.
+    :return: numpy array of the same shape as b representing the solution of the linear system
+    """
+    return LUsolve_csr_split(split_LU(sLU, iLU, jLU), b)
+
+
+def split_LU(sLU, iLU, jLU):
+    """
+    Splits a LU decomposition in CSR format into the strictly lower triangular part L (without its unit diagonal),
+    the strictly upper triangular part U, both in CSR format, and the inverse of the diagonal of U.
+    :param sLU, iLU, jLU: 3 numpy 1D arrays representing a LU decomposition in CSR format
+    :return: a tuple (sL, iL, jL, sU, iU, jU, dinv)
     """
+    N = len(iLU) - 1
+    rows = np.repeat(np.arange(N), np.diff(iLU))
+    parts = []
+    for part in (jLU < rows, jLU > rows):
+        iT = np.zeros(N + 1, dtype=int)
+        iT[1:] = np.cumsum(np.bincount(rows[part], minlength=N))
+        parts += [sLU[part], iT, jLU[part]]
+    dinv = np.zeros(N, dtype=complex)
+    dinv[rows[jLU == rows]] = 1 / sLU[jLU == rows]
+    return tuple(parts) + (dinv,)
+
+
+def LUsolve_csr_split(LU, b, levels=None):
+    """
+    Solves the two triangular systems Ly = b and Ux = y with a LU decomposition split by split_LU.
+    The lines are solved level by level (see triangular_levels) : all the lines of a level at once.
+    :param LU: the tuple (sL, iL, jL, sU, iU, jU, dinv) representing a LU decomposition (result of split_LU)
+    :param b: numpy 1D array, right member of the linear system to solve : LUx = b.
+               It can also be a 2D array of shape (len(b), k) : the k systems are solved at once.
+    :param levels: result of triangular_levels(iL, jL, iU, jU), computed here if None.
+                    It only depends on the structure of LU and is given to solve several systems.
+    :return: numpy array of the same shape as b representing the solution of the linear system
+    """
+    sL, iL, jL, sU, iU, jU, dinv = LU
     b = np.array(b)
-    N = len(b)
+    if levels is None:
+        levels = triangular_levels(iL, jL, iU, jU)
+    lower, upper = levels
+    # the values of a line multiply the columns of all the right members
+    shape = (-1,) + (1,) * (b.ndim - 1)
 
     # Solves Lower triangular system Ly = b
-    y = np.zeros(N, dtype=complex)
-    for i in range(N):
-        # Only does the scalar product for non-zero elements of L
-        idx = iLU[i] + np.where(jLU[iLU[i]:iLU[i+1]] < i+1)[0]
-        y[i] = b[i] - np.dot(sLU[idx], y[jLU[idx]])
+    y = np.zeros(b.shape, dtype=complex)
+    for lines, nz_lines, idx, cols, starts in lower:
+        y[lines] = b[lines]
+        if len(idx) > 0:
+            y[nz_lines] -= np.add.reduceat(sL[idx].reshape(shape) * y[cols], starts)
 
     # Solves Upper triangular system Ux = y
-    x = np.zeros(N, dtype=complex)
-    for i in range(N - 1, -1, -1):
-        # Only does the scalar product for non-zero elements of U
-        idx = iLU[i] + np.where(jLU[iLU[i]:iLU[i + 1]] > i)[0]
-        x[i] = (y[i] - np.dot(sLU[idx], x[jLU[idx]])) / (sLU[iLU[i] + np.where(jLU[iLU[i]:iLU[i+1]] == i)[0]])
+    x = np.zeros(b.shape, dtype=complex)
+    for lines, nz_lines, idx, cols, starts in upper:
+        x[lines] = y[lines]
+        if len(idx) > 0:
+            x[nz_lines] -= np.add.reduceat(sU[idx].reshape(shape) * x[cols], starts)
+        x[lines] *= dinv[lines].reshape(shape)
     return x
 
 
-# ============= RCMK FUNCTIONS =============
+def triangular_levels(iL, jL, iU, jU):
+    """
+    Analyses the dependencies between the lines of the triangular systems L and U of a LU decomposition
+    (level scheduling). In Ly = b, the line i needs the lines jL[k] of its non-zero elements : it belongs
+    to the level following the highest level of these lines, so that all the lines of a level only
+    depend on the previous levels and can be solved at once. Same for Ux = y, from the last line.
+    :param iL, jL, iU, jU: the indices vectors of L and U in CSR format (result of split_LU)
+    :return: a tuple (lower, upper) of the lists of the levels of L and U in the order they are solved.
+              A level is a tuple (lines, nz_lines, idx, cols, starts) :
+                lines: the lines of the level,
+                nz_lines: the lines of the level that have non-zero elements,
+                idx, cols: the indices in sL (or sU) and the columns of these elements, grouped by line,
+                starts: the index in idx of the first element of each line of nz_lines.
+    """
+    N = len(iL) - 1
+    return levels_of(iL, jL, range(N)), levels_of(iU, jU, range(N - 1, -1, -1))
+
+
+def levels_of(iT, jT, order):
+    """
+    Computes the levels of the lines of a triangular matrix (see triangular_levels).
+    :param iT, jT: the indices vectors of the triangular matrix in CSR format
+    :param order: the order in which the lines are solved
+    """
+    N = len(iT) - 1
+    count = np.diff(iT)
+
+    # The level of a line is 1 + the highest level of the lines it needs (0 if it needs none)
+    level = [0] * N
+    ptr, cols = iT.tolist(), jT.tolist()
+    for i in order:
+        level[i] = max([level[j] for j in cols[ptr[i]:ptr[i+1]]], default=-1) + 1
+
+    # Groups the lines, and their elements, by level
+    level = np.array(level, dtype=int)
+    lines = np.argsort(level, kind='stable')
+    bounds = np.cumsum(np.bincount(level, minlength=1))
+    nz = count[lines]
+    entries = np.repeat(iT[lines], nz) + np.arange(nz.sum()) - np.repeat(np.cumsum(nz) - nz, nz)
+    entry_bounds = np.cumsum(nz)
+
+    levels = []
+    for k in range(len(bounds)):
+        first, last = (bounds[k-1] if k > 0 else 0), bounds[k]
+        level_lines = lines[first:last]
+        level_nz = nz[first:last]
+        level_idx = entries[(entry_bounds[first-1] if first > 0 else 0):entry_bounds[last-1]]
+        starts = (np.cumsum(level_nz) - level_nz)[level_nz > 0]
+        levels.append((level_lines, level_lines[level_nz > 0], level_idx, jT[level_idx], starts))
+    return levels
 
 
 def RCMK(iA, jA):
@@ -312,7 +634,8 @@ def LUsolve(LU, b, P):
             Ux = y
         knowing that L and U are lower and upper triangular matrices respectively
     :param LU: Numpy 2D array representing the LU decomposition of a coefficient matrix A (L and U combined, result of LU(A))
-    :param b: Numpy 1D array representing the independt terms of the linear system : Ax = b
+    :param b: Numpy 1D array representing the independt terms of the linear system : Ax = b.
+              It can also be a 2D array (one right member per column), all the systems are then solved at once.
     :param P: Numpy 1D array representing the permutation vector (result of LU(A))
     :return: the solution to the linear system Ax = b and LUx = Pb (both are equivalent)
     """
@@ -322,13 +645,14 @@ def LUsolve(LU, b, P):
             Ux = y
         knowing that L and U are lower and upper triangular matrices respectively
     """
+    b = np.array(b)
     N = len(LU)
-    y = np.zeros(N, dtype=complex)
+    y = np.zeros(b.shape, dtype=complex)
     for i in range(N):
-        y[i:i+1] = (b[P[i]] - np.dot(LU[P[i], :i+1], y[:i+1]))
-    x = np.zeros(N, dtype=complex)
+        y[i] = b[P[i]] - np.dot(LU[P[i], :i], y[:i])
+    x = np.zeros(b.shape, dtype=complex)
     for i in range(N-1, -1, -1):
-        x[i:i+1] = (y[i] - np.dot(LU[P[i], i:], x[i:])) / LU[P[i], i]
+        x[i] = (y[i] - np.dot(LU[P[i], i+1:], x[i+1:])) / LU[P[i], i]
     return x
 
 
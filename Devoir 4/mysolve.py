@@ -1,4 +1,9 @@
 import numpy as np
+import scipy.sparse
+import scipy.linalg
+import hashlib
+import heapq
+import collections
 
 # The function mysolve(A, b) is invoked by ndt.py
 # to solve the linear system
@@ -9,37 +14,251 @@ import numpy as np
 SolverType = 'GMRES'
 rtol = 1e-8
 prec = True
-
-
-def mysolve(A, b):
+restart = None  # restart length of GMRES, None : no restart
+ortho = 'CGS2'  # orthogonalization of the Krylov basis : 'CGS2' or 'MGS'
+side = 'left'   # preconditionning of GMRES : 'left', 'right' or 'flexible'
+deflate = 0     # number of harmonic Ritz vectors kept at each restart (GMRES-DR), 0 : plain restart
+precType = 'ILU0'   # preconditioner : 'ILU0', 'ILUk', 'ILUT' or 'AMG'
+fill = 1            # level of fill-in of ILU(k)
+ilut = (10, 1e-4)   # (p, tau) of ILUT : elements kept by line in L and in U, dropping tolerance
+symmetric = True    # CG (SPD) or COCG (complex symmetric) instead of GMRES when the structure of A is given
+
+
+def mysolve(A, b, structure=None):
+    # structure is 'spd' (symmetric positive definite), 'symmetric' (complex symmetric) or None (general),
+    # as known by the assembly
     if SolverType == 'numpy':
+        if scipy.sparse.issparse(A):
+            A = A.toarray()
         return True, np.linalg.solve(A, b)
+    elif SolverType == 'GMRES' and symmetric and structure in ('spd', 'symmetric'):
+        sA, iA, jA = CSRformat(A)
+        # CG needs a symmetric preconditioner : the V-cycle of AMG (ILU is not symmetric)
+        M = factorize(sA, iA, jA, 'AMG').solve if prec else None
+        cocg = structure == 'symmetric'
+        if np.ndim(b) == 1:
+            x, res = csrCG(sA, iA, jA, b, rtol, M, cocg=cocg)
+            return True, x
+        x = np.column_stack([csrCG(sA, iA, jA, bk, rtol, M, cocg=cocg)[0] for bk in np.transpose(b)])
+        return True, x
     elif SolverType == 'GMRES':
         sA, iA, jA = CSRformat(A)
-        x, res = csrGMRES(sA, iA, jA, b, rtol, prec)
+        # The preconditioner is computed once per matrix, and once for all the right members
+        ILU = factorize(sA, iA, jA, precType, fill, *ilut) if prec else None
+        if prec and ILU.singular:
+            return False, 0
+        if np.ndim(b) == 1:
+            x, res = csrGMRES(sA, iA, jA, b, rtol, prec, ILU=ILU, restart=restart, deflate=deflate, ortho=ortho,
+                              side=side)
+            return True, x
+        x = np.column_stack([csrGMRES(sA, iA, jA, bk, rtol, prec, ILU=ILU, restart=restart, deflate=deflate,
+                                      ortho=ortho, side=side)[0]
+                             for bk in np.transpose(b)])
         return True, x
     else:
         return False, 0
 
 
+# ILU decompositions computed by mysolve, keyed by the preconditioner and the matrix (structure and values),
+# the least recently used first. Solving again with the same matrix does not decompose it again.
+factorizations = collections.OrderedDict()
+FACTOR_CACHE_SIZE = 4
+
+# Symbolic analyses of the ILU(k) decompositions (see analyse), keyed by k and the sparsity pattern :
+# a matrix with new values but the same pattern (another freq, vel or mur) only needs the numeric phase.
+patterns = collections.OrderedDict()
+PATTERN_CACHE_SIZE = 4
+
+
+class ILUkFactor:
+    """
+    ILU(k) decomposition of a matrix A in CSR format, used as preconditioner. k = 0 is ILU(0) (see csrILU0), for k > 0
+    the decomposition keeps the fill-in of level at most k (see csrILUkPattern).
+    """
+    def __init__(self, sA, iA, jA, k=0):
+        self.N = len(iA) - 1
+        symbolic = analyse(iA, jA, k)
+        self.LU = csrILU0Numeric(sA, symbolic, split=True)
+        self.singular = self.LU is None
+        # the level scheduling of the triangular solves, shared by all the solves
+        self.levels = None if self.singular else symbolic['levels']
+
+    def solve(self, b):
+        """
+        @:param b: numpy 1D (or 2D, one right member per column) array
+        @:return: the solution x of LUx = b
+        """
+        return csrLUsolve_split(self.LU, b, self.levels)
+
+
+class ILUTFactor:
+    """
+    ILUT(p, tau) decomposition of a matrix A in CSR format (see csrILUT), used as preconditioner.
+    """
+    def __init__(self, sA, iA, jA, p=10, tau=1e-4):
+        self.N = len(iA) - 1
+        self.LU = csrILUT(sA, iA, jA, p, tau)
+        self.singular = self.LU is None
+        # the pattern of the decomposition depends on the values : its levels are computed for this matrix only
+        self.levels = None if self.singular else triangular_levels(*self.LU[1:3], *self.LU[4:6])
+
+    def solve(self, b):
+        """
+        @:param b: numpy 1D (or 2D, one right member per column) array
+        @:return: the solution x of LUx = b
+        """
+        return csrLUsolve_split(self.LU, b, self.levels)
+
+
+class QRFactor:
+    """
+    QR decomposition of a full matrix A (M x N, M >= N), solves the systems Ax = b in the least squares sense.
+    """
+    def __init__(self, A):
+        self.Q, self.R = np.linalg.qr(A)
+        self.N = self.R.shape[1]
+
+    def solve(self, b):
+        """
+        Solves the system R x = Q^* b knowing that R is an upper triangular matrix.
+        @:param b: numpy 1D (or 2D, one right member per column) array
+        @:return: the solution x
+        """
+        y = np.dot(self.Q.conjugate().T, b)
+        x = np.zeros((self.N,) + np.shape(b)[1:], dtype=complex)
+        for i in range(self.N - 1, -1, -1):
+            x[i] = (y[i] - np.dot(self.R[i, i+1:], x[i+1:])) / self.R[i, i]
+        return x
+
+
+def matrix_key(method, *arrays):
+    """
+    Computes the key of a matrix in the caches : the method and a digest of the arrays representing the matrix
+    (its values and its structure, or only its structure).
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(str((array.dtype, array.shape)).encode())
+        digest.update(array.tobytes())
+    return method, digest.hexdigest()
+
+
+def analyse(iA, jA, k=0):
+    """
+    Returns the symbolic analysis of the ILU(k) decomposition of a matrix with the sparsity pattern iA, jA,
+    from the cache if a matrix with the same pattern was already decomposed.
+    For k > 0, the analysis is the one of ILU(0) on the pattern of the fill-in of level at most k, the elements of A
+    being put in this pattern by sF[symbolic['place']] = sA.
+    @:param iA, jA: the indices vectors of a matrix in CSR format
+    @:param k: integer, level of fill-in
+    @:return: the result of csrILU0Symbolic
+    """
+    key = matrix_key(('ILU', k), iA, jA)
+    if key in patterns:
+        patterns.move_to_end(key)
+        return patterns[key]
+
+    if k == 0:
+        symbolic = csrILU0Symbolic(iA, jA)
+    else:
+        iF, jF, place = csrILUkPattern(iA, jA, k)
+        symbolic = csrILU0Symbolic(iF, jF)
+        if symbolic is not None:
+            symbolic['place'] = place
+    patterns[key] = symbolic
+    while len(patterns) > PATTERN_CACHE_SIZE:
+        patterns.popitem(last=False)
+    return symbolic
+
+
+def factorize(sA, iA, jA, method='ILU0', k=1, p=10, tau=1e-4):
+    """
+    Returns the ILU decomposition of the matrix A in CSR format, from the cache if A was already decomposed.
+    @:param sA, iA, jA: 3 1D numpy arrays representing matrix A in CSR format
+    @:param method: 'ILU0', 'ILUk' (level of fill-in k), 'ILUT' (at most p elements by line in L and in U,
+                    elements smaller than tau times the norm of their line of A dropped) or 'AMG' (not an ILU
+                    decomposition, but used the same way)
+    @:return: an ILUkFactor, an ILUTFactor or an AMGPreconditioner, with a method solve(b)
+    """
+    params = {'ILU0': (), 'ILUk': (k,), 'ILUT': (p, tau), 'AMG': ()}[method]
+    key = matrix_key((method,) + params, sA, iA, jA)
+    if key in factorizations:
+        factorizations.move_to_end(key)
+        return factorizations[key]
+
+    if method == 'ILUT':
+        factor = ILUTFactor(sA, iA, jA, p, tau)
+    elif method == 'AMG':
+        factor = AMGPreconditioner(sA, iA, jA)
+    else:
+        factor = ILUkFactor(sA, iA, jA, *params)
+    if not factor.singular:
+        factorizations[key] = factor
+        while len(factorizations) > FACTOR_CACHE_SIZE:
+            factorizations.popitem(last=False)
+    return factor
+
+
 def CSRformat(A):
     """
     Translates the matrix A in the CSR format.
-    @:param A: 2D numpy array (or matrix) to convert in CSR format
+    @:param A: 2D numpy array (or matrix) or scipy sparse matrix to convert in CSR format
     @:return: a tuple containing 3 1D numpy arrays:
         sA[s] contains the sth non-zero element of A
         iA[i] contains the index in sA containing the first non-zero element of the line i in A
         jA[j] contains the index of the column containing the jth non-zero element of A
     """
+    if scipy.sparse.issparse(A):
+        if A.format == 'csr' and A.has_canonical_format:
+            # Already sorted and without duplicates : its arrays are used as they are
+            return A.data, A.indptr.astype(int, copy=False), A.indices.astype(int, copy=False)
+        # A sparse matrix is never expanded : it is rebuilt from its triplets
+        A = scipy.sparse.coo_matrix(A)
+        return COOtoCSR(A.row, A.col, A.data, A.shape[0])
+
     A = np.array(A)
-    idx = np.nonzero(A)     # Gets the indices of non-zero elements in A
+    idx = np.nonzero(A)     # Gets the indices of non-zero elements in A (sorted by line, then by column)
     sA = A[idx]             # Storing non-zero elements in sA
     jA = idx[1]             # Storing the columns of the non-zero elements
 
+    # Counting the number of non-zero elements in each line
     iA = np.zeros(len(A)+1, dtype=int)
-    for i in range(1, len(iA)):
-        # Counting the number of non-zero elements in the ith line
-        iA[i] = iA[i-1] + np.sum(idx[0][iA[i-1]:] == i-1)
+    iA[1:] = np.cumsum(np.bincount(idx[0], minlength=len(A)))
+
+    return sA, iA, jA
+
+
+def COOtoCSR(rows, cols, vals, N):
+    """
+    Builds the CSR format of the N x N matrix given by its triplets (rows[k], cols[k], vals[k]), as produced by the
+    assembly, without any dense intermediate. Duplicate entries are summed and the columns of each line are sorted.
+    The cost is the one of sorting the triplets : O(nnz log nnz).
+    @:param rows, cols: 1D numpy arrays of integers, line and column of each triplet
+    @:param vals: 1D numpy array, value of each triplet. It can also be a 2D array (one column per matrix)
+                  to build at once several matrices sharing the same sparsity pattern, sA is then 2D as well.
+    @:param N: integer, dimension of the matrix
+    @:return: 3 1D numpy arrays sA, iA, jA representing the matrix in CSR format
+    """
+    rows = np.asarray(rows, dtype=int)
+    cols = np.asarray(cols, dtype=int)
+    vals = np.asarray(vals)
+    if len(vals) == 0:
+        return vals.copy(), np.zeros(N+1, dtype=int), np.zeros(0, dtype=int)
+
+    # Sorting the triplets by line then by column
+    key = rows * N + cols
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+
+    # Each group of equal keys is one entry of the CSR matrix, its duplicates are summed
+    first = np.concatenate(([True], key[1:] != key[:-1]))
+    start = np.nonzero(first)[0]
+    sA = np.add.reduceat(vals[order], start)
+    jA = key[start] % N
+
+    iA = np.zeros(N+1, dtype=int)
+    iA[1:] = np.cumsum(np.bincount(key[start] // N, minlength=N))
 
     return sA, iA, jA
 
@@ -61,49 +280,208 @@ def QRsolve(A, b):
     This function implements a solver for the QR decompostion. It solves the system :
         R x = Q^* b
     knowing that R is an upper triangular matrix.
+    b can also be a 2D array (one right member per column) : A is then factorized once for all of them.
     """
-    Q, R = np.linalg.qr(A)
-    M, N = np.shape(Q)
-    y = np.dot(b, Q.conjugate())
-    x = np.zeros(N, dtype=complex)
-    for i in range(N - 1, -1, -1):
-        x[i:i + 1] = (y[i] - np.dot(R[i, i:], x[i:])) / R[i, i]
-    return x
+    return QRFactor(A).solve(b)
 
 
-def csrILU0(sA, iA, jA):
+def csrILU0(sA, iA, jA, split=False):
     """
     This function computes the ILU(0) decomposition of the CSR matrix A represented by sA, iA and jA and returns a
     CSR format matrix representative of L and U (lower and upper triangular matrices)
-    @:param sA, iA, jA: 3 1D numpy arrays representing matrix A in CSR format
-    @:return: 3 1D numpy arrays representing ILU(0) decomposition of A in CSR format
+    The updates are first located by csrILU0Symbolic, then applied by csrILU0Numeric.
+    @:param sA, iA, jA: 3 1D numpy arrays representing matrix A in CSR format (columns sorted in each line)
+    @:param split: if True, the decomposition is returned split by csrSplitLU
+    @:return: 3 1D numpy arrays representing ILU(0) decomposition of A in CSR format.
+              If split is True : the tuple (sL, iL, jL, sU, iU, jU, dinv) (see csrSplitLU), None if A is singular.
     """
+    return csrILU0Numeric(sA, csrILU0Symbolic(iA, jA), split)
 
-    N = len(iA) - 1
-
-    band_l, band_u = compute_bands(iA, jA)
 
-    sILU = sA.copy()
-    iILU = iA.copy()
-    jILU = jA.copy()
+def csrILU0Symbolic(iA, jA):
+    """
+    Analyses the sparsity pattern of A for the ILU(0) decomposition (line by line, IKJ variant) : for each element
+    (i, k) of L, a_ik /= a_kk then a_ij -= a_ik a_kj for the elements (k, j), j > k, of U such that (i, j) is in the
+    pattern. The indices in sA of all these elements are computed once.
+    The lines are grouped by level (as in triangular_levels) : the lines of a level only need lines of the previous
+    levels, so that the p-th elements of L of all the lines of a level are handled at once, in a step.
+    The analysis only depends on the pattern : it is computed once for all the matrices with this pattern
+    (see analyse), csrILU0Numeric then only computes the values.
+    @:param iA, jA: the indices vectors of a matrix in CSR format (columns sorted in each line)
+    @:return: a dictionary with iA, jA, diag (the indices in sA of the diagonal elements) and steps, the list of the
+              steps in the order they are applied. A step is a tuple (piv, diag, target, source, mult) of indices in
+              sA : sA[piv] /= sA[diag], then sA[target] -= sA[mult] * sA[source].
+              It also holds levels, the level scheduling of the triangular solves with the decomposition
+              (see triangular_levels). None if a diagonal element is not in the pattern.
+    """
+    N = len(iA) - 1
+    rows = np.repeat(np.arange(N), np.diff(iA))
+    diag = np.full(N, -1)
+    diag[rows[jA == rows]] = np.nonzero(jA == rows)[0]
+    if np.any(diag < 0):
+        return None
+
+    ptr, cols, diag_list = iA.tolist(), jA.tolist(), diag.tolist()
+    level = [0] * N
+    steps = {}
+    for i in range(N):
+        position = {cols[q]: q for q in range(ptr[i], ptr[i+1])}
+        lower = range(ptr[i], diag_list[i])
+        level[i] = max([level[cols[q]] for q in lower], default=-1) + 1
+        for p, q in enumerate(lower):
+            k = cols[q]
+            piv, diag_k, target, source, mult = steps.setdefault((level[i], p), ([], [], [], [], []))
+            piv.append(q)
+            diag_k.append(diag_list[k])
+            # the elements (k, j), j > k of U that update the line i (its next elements of L as well)
+            for r in range(diag_list[k] + 1, ptr[k+1]):
+                t = position.get(cols[r])
+                if t is not None:
+                    target.append(t)
+                    source.append(r)
+                    mult.append(q)
+
+    # only the patterns of L and U (as split by csrSplitLU) are needed for the levels of the triangular solves
+    patterns = []
+    for part in (jA < rows, jA > rows):
+        iT = np.zeros(N + 1, dtype=int)
+        iT[1:] = np.cumsum(np.bincount(rows[part], minlength=N))
+        patterns += [iT, jA[part]]
+    return {'iA': iA, 'jA': jA, 'diag': diag,
+            'steps': [tuple(np.array(indices, dtype=int) for indices in steps[key]) for key in sorted(steps)],
+            'levels': triangular_levels(*patterns)}
+
+
+def csrILU0Numeric(sA, symbolic, split=False):
+    """
+    Computes the ILU(0) decomposition of A with the analysis of its pattern.
+    @:param sA: 1D numpy array, the values of A in CSR format
+    @:param symbolic: result of csrILU0Symbolic(iA, jA)
+    @:param split: if True, the decomposition is returned split by csrSplitLU
+    @:return: same as csrILU0
+    """
+    if symbolic is None:
+        return None if split else (None, None, None)
+
+    sILU = np.array(sA, dtype=np.result_type(sA, float))
+    if symbolic.get('place') is not None:
+        # ILU(k) : the elements of A in the pattern of the fill-in
+        sILU = np.zeros(len(symbolic['jA']), dtype=sILU.dtype)
+        sILU[symbolic['place']] = sA
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for piv, diag, target, source, mult in symbolic['steps']:
+            sILU[piv] /= sILU[diag]
+            sILU[target] -= sILU[mult] * sILU[source]
+    if np.any(sILU[symbolic['diag']] == 0):
+        return None if split else (None, None, None)
+
+    if split:
+        return csrSplitLU(sILU, symbolic['iA'], symbolic['jA'])
+    return sILU, symbolic['iA'].copy(), symbolic['jA'].copy()
+
+
+def csrILUkPattern(iA, jA, k):
+    """
+    Computes the pattern of the ILU(k) decomposition : the fill-in of level at most k. The elements of A have the level
+    0 and the update of (i, j) by (i, m) and (m, j) creates an element of level lev(i, m) + lev(m, j) + 1.
+    @:param iA, jA: the indices vectors of a matrix in CSR format (columns sorted in each line)
+    @:param k: integer, level of fill-in
+    @:return: iF, jF, the pattern of the decomposition in CSR format, and place, the indices in it of the elements of A
+    """
+    N = len(iA) - 1
+    ptr, cols = iA.tolist(), jA.tolist()
+    upper = [None] * N          # (column, level) of the elements of U of each line
+    lines = []
+    for i in range(N):
+        level = {j: 0 for j in cols[ptr[i]:ptr[i+1]]}
+        lower = [j for j in level if j < i]
+        heapq.heapify(lower)
+        while lower:
+            m = heapq.heappop(lower)
+            for j, level_mj in upper[m]:
+                new = level[m] + level_mj + 1
+                if new <= k:
+                    if j not in level:
+                        level[j] = new
+                        if j < i:
+                            heapq.heappush(lower, j)
+                    elif new < level[j]:
+                        level[j] = new
+        line = sorted(level)
+        upper[i] = [(j, level[j]) for j in line if j > i]
+        lines.append(line)
+
+    iF = np.zeros(N + 1, dtype=int)
+    iF[1:] = np.cumsum([len(line) for line in lines])
+    jF = np.array([j for line in lines for j in line], dtype=int)
+
+    # the elements of A, sorted by line and column, are found in the (sorted) pattern
+    rows = np.repeat(np.arange(N), np.diff(iA))
+    rowsF = np.repeat(np.arange(N), np.diff(iF))
+    place = np.searchsorted(rowsF * N + jF, rows * N + jA)
+    return iF, jF, place
+
+
+def csrILUT(sA, iA, jA, p=10, tau=1e-4):
+    """
+    Computes the ILUT(p, tau) decomposition of A (dual threshold, line by line) : during the elimination of the line
+    i, the elements of L smaller than tau ||a_i|| are dropped, then only the p largest elements of L and the p
+    largest elements of U larger than tau ||a_i|| are kept. The size of the decomposition is at most (2p+1) N.
+    The elements of L are compared before their division by the pivot, so that the rule does not depend on the
+    scale of A.
+    @:param sA, iA, jA: 3 1D numpy arrays representing matrix A in CSR format
+    @:param p: integer, number of elements kept by line in L and in U
+    @:param tau: float, relative dropping tolerance
+    @:return: the tuple (sL, iL, jL, sU, iU, jU, dinv) (see csrSplitLU), None if a pivot is zero.
+    """
+    N = len(iA) - 1
+    w = np.zeros(N, dtype=np.result_type(sA, complex))    # the line being eliminated (full)
+    Lcols, Lvals, Ucols, Uvals = [], [], [], []
+    dinv = np.zeros(N, dtype=w.dtype)
 
     for i in range(N):
-        a_ii = sILU[iILU[i] + np.where(jILU[iILU[i]:iILU[i+1]] == i)[0]]
-        if abs(a_ii) == 0:
-            return None, None, None
-
-        for j in range(i+1, min(i+1+band_l, N)):
-                idx = np.where(jILU[iILU[j]:iILU[j + 1]] == i)[0]
-                if idx.size > 0:
-                    ji_idx = iILU[j] + idx[0]
-                    sILU[ji_idx] /= a_ii
-                    for k in range(iILU[i], iILU[i+1]):
-                        if i+1 <= jILU[k] < min(i + 1 + band_u, N):
-                            idx2 = np.where(jILU[iILU[j]:iILU[j+1]] == jILU[k])[0]
-                            if idx2.size > 0:
-                                idx_to_change = iILU[j] + idx2[0]
-                                sILU[idx_to_change] -= sILU[ji_idx] * sILU[k]
-    return sILU, iILU, jILU
+        cols = jA[iA[i]:iA[i+1]]
+        w[cols] = sA[iA[i]:iA[i+1]]
+        tol = tau * np.linalg.norm(sA[iA[i]:iA[i+1]])
+        nz = set(cols.tolist())
+        lower = [j for j in nz if j < i]
+        heapq.heapify(lower)
+        while lower:
+            m = heapq.heappop(lower)
+            if abs(w[m]) < tol:
+                w[m] = 0
+                continue
+            w[m] *= dinv[m]
+            w[Ucols[m]] -= w[m] * Uvals[m]
+            for j in Ucols[m].tolist():
+                if j not in nz:
+                    nz.add(j)
+                    if j < i:
+                        heapq.heappush(lower, j)
+
+        idx = np.array(sorted(nz), dtype=int)
+        vals = w[idx]
+        w[idx] = 0
+        if i not in nz or vals[np.searchsorted(idx, i)] == 0:
+            return None
+        dinv[i] = 1 / vals[np.searchsorted(idx, i)]
+
+        # dropping : the p largest elements larger than tol in L (before the division by the pivots) and in U
+        size = np.abs(vals)
+        size[idx < i] /= np.abs(dinv[idx[idx < i]])
+        for part, cols_list, vals_list in ((idx < i, Lcols, Lvals), (idx > i, Ucols, Uvals)):
+            keep = np.nonzero(part & (size >= tol))[0]
+            if len(keep) > p:
+                keep = np.sort(keep[np.argsort(-size[keep], kind='stable')[:p]])
+            cols_list.append(idx[keep])
+            vals_list.append(vals[keep])
+
+    split = []
+    for cols_list, vals_list in ((Lcols, Lvals), (Ucols, Uvals)):
+        iT = np.zeros(N + 1, dtype=int)
+        iT[1:] = np.cumsum([len(cols) for cols in cols_list])
+        split += [np.concatenate(vals_list), iT, np.concatenate(cols_list)]
+    return tuple(split) + (dinv,)
 
 
 def csrLUsolve(sLU, iLU, jLU, b):
@@ -111,98 +489,521 @@ def csrLUsolve(sLU, iLU, jLU, b):
     Solves the two triangular systems Ly = b and Ux = y in sparse format and returns solution array x
     @:param sLU, iLU, jLU: 3 numpy 1D arrays representing a LU decomposition in CSR format
                          of a matrix of dimension len(b) x len(b)
-    @:param b: numpy 1D array, right member of the linear system to solve : LUx = b
-    @:return: numpy 1D array representing the solution of the linear system
+    @:param b: numpy 1D array, right member of the linear system to solve : LUx = b.
+               It can also be a 2D array of shape (len(b), k) : the k systems are solved at once.
+    @:return: numpy array of the same shape as b representing the solution of the linear system
+    """
+    return csrLUsolve_split(csrSplitLU(sLU, iLU, jLU), b)
+
+
+def csrSplitLU(sLU, iLU, jLU):
+    """
+    Splits a LU decomposition in CSR format into the strictly lower triangular part L (without its unit diagonal),
+    the strictly upper triangular part U, both in CSR format, and the inverse of the diagonal of U.
+    @:param sLU, iLU, jLU: 3 numpy 1D arrays representing a LU decomposition in CSR format
+    @:return: a tuple (sL, iL, jL, sU, iU, jU, dinv)
     """
+    N = len(iLU) - 1
+    rows = np.repeat(np.arange(N), np.diff(iLU))
+    parts = []
+    for part in (jLU < rows, jLU > rows):
+        iT = np.zeros(N + 1, dtype=int)
+        iT[1:] = np.cumsum(np.bincount(rows[part], minlength=N))
+        parts += [sLU[part], iT, jLU[part]]
+    dinv = np.zeros(N, dtype=complex)
+    dinv[rows[jLU == rows]] = 1 / sLU[jLU == rows]
+    return tuple(parts) + (dinv,)
+
+
+def csrLUsolve_split(LU, b, levels=None):
+    """
+    Solves the two triangular systems Ly = b and Ux = y with a LU decomposition split by csrSplitLU.
+    The lines are solved level by level (see triangular_levels) : all the lines of a level at once.
+    @:param LU: the tuple (sL, iL, jL, sU, iU, jU, dinv) representing a LU decomposition (result of csrSplitLU)
+    @:param b: numpy 1D array, right member of the linear system to solve : LUx = b.
+               It can also be a 2D array of shape (len(b), k) : the k systems are solved at once.
+    @:param levels: result of triangular_levels(iL, jL, iU, jU), computed here if None.
+                    It only depends on the structure of LU and is given to solve several systems.
+    @:return: numpy array of the same shape as b representing the solution of the linear system
+    """
+    sL, iL, jL, sU, iU, jU, dinv = LU
     b = np.array(b)
-    N = len(b)
+    if levels is None:
+        levels = triangular_levels(iL, jL, iU, jU)
+    lower, upper = levels
+    # the values of a line multiply the columns of all the right members
+    shape = (-1,) + (1,) * (b.ndim - 1)
 
     # Solves Lower triangular system Ly = b
-    y = np.zeros(N, dtype=complex)
-    for i in range(N):
-        # Only does the scalar product for non-zero elements of L
-        idx = iLU[i] + np.where(jLU[iLU[i]:iLU[i+1]] < i+1)[0]
-        y[i] = b[i] - np.dot(sLU[idx].conj(), y[jLU[idx]])
+    y = np.zeros(b.shape, dtype=complex)
+    for lines, nz_lines, idx, cols, starts in lower:
+        y[lines] = b[lines]
+        if len(idx) > 0:
+            y[nz_lines] -= np.add.reduceat(sL[idx].reshape(shape) * y[cols], starts)
 
     # Solves Upper triangular system Ux = y
-    x = np.zeros(N, dtype=complex)
-    for i in range(N - 1, -1, -1):
-        # Only does the scalar product for non-zero elements of U
-        idx = iLU[i] + np.where(jLU[iLU[i]:iLU[i + 1]] > i)[0]
-        x[i] = (y[i] - np.dot(sLU[idx].conj(), x[jLU[idx]])) / (sLU[iLU[i] + np.where(jLU[iLU[i]:iLU[i+1]] == i)[0]])
+    x = np.zeros(b.shape, dtype=complex)
+    for lines, nz_lines, idx, cols, starts in upper:
+        x[lines] = y[lines]
+        if len(idx) > 0:
+            x[nz_lines] -= np.add.reduceat(sU[idx].reshape(shape) * x[cols], starts)
+        x[lines] *= dinv[lines].reshape(shape)
     return x
 
 
+def triangular_levels(iL, jL, iU, jU):
+    """
+    Analyses the dependencies between the lines of the triangular systems L and U of a LU decomposition
+    (level scheduling). In Ly = b, the line i needs the lines jL[k] of its non-zero elements : it belongs
+    to the level following the highest level of these lines, so that all the lines of a level only
+    depend on the previous levels and can be solved at once. Same for Ux = y, from the last line.
+    @:param iL, jL, iU, jU: the indices vectors of L and U in CSR format (result of csrSplitLU)
+    @:return: a tuple (lower, upper) of the lists of the levels of L and U in the order they are solved.
+              A level is a tuple (lines, nz_lines, idx, cols, starts) :
+                lines: the lines of the level,
+                nz_lines: the lines of the level that have non-zero elements,
+                idx, cols: the indices in sL (or sU) and the columns of these elements, grouped by line,
+                starts: the index in idx of the first element of each line of nz_lines.
+    """
+    N = len(iL) - 1
+    return levels_of(iL, jL, range(N)), levels_of(iU, jU, range(N - 1, -1, -1))
+
+
+def levels_of(iT, jT, order):
+    """
+    Computes the levels of the lines of a triangular matrix (see triangular_levels).
+    @:param iT, jT: the indices vectors of the triangular matrix in CSR format
+    @:param order: the order in which the lines are solved
+    """
+    N = len(iT) - 1
+    count = np.diff(iT)
+
+    # The level of a line is 1 + the highest level of the lines it needs (0 if it needs none)
+    level = [0] * N
+    ptr, cols = iT.tolist(), jT.tolist()
+    for i in order:
+        level[i] = max([level[j] for j in cols[ptr[i]:ptr[i+1]]], default=-1) + 1
+
+    # Groups the lines, and their elements, by level
+    level = np.array(level, dtype=int)
+    lines = np.argsort(level, kind='stable')
+    bounds = np.cumsum(np.bincount(level, minlength=1))
+    nz = count[lines]
+    entries = np.repeat(iT[lines], nz) + np.arange(nz.sum()) - np.repeat(np.cumsum(nz) - nz, nz)
+    entry_bounds = np.cumsum(nz)
+
+    levels = []
+    for k in range(len(bounds)):
+        first, last = (bounds[k-1] if k > 0 else 0), bounds[k]
+        level_lines = lines[first:last]
+        level_nz = nz[first:last]
+        level_idx = entries[(entry_bounds[first-1] if first > 0 else 0):entry_bounds[last-1]]
+        starts = (np.cumsum(level_nz) - level_nz)[level_nz > 0]
+        levels.append((level_lines, level_lines[level_nz > 0], level_idx, jT[level_idx], starts))
+    return levels
+
+
 def csrMult(sA, iA, jA, v):
     """
     Performs the matrix, vector dot product between the matrix A represented by sA, iA and jA and the vector v
         In full : returns A @ v
     @:param sA, iA, jA: 3 1D numpy arrays representing a matrix in CSR format
-    @:param v: 1D numpy array on which to perform dot product.
-    @:return: a 1D numpy array representing the dot product of A and v
+    @:param v: 1D numpy array on which to perform dot product. It can also be a 2D array of shape (N, k) :
+               the k products A @ v[:, j] are then performed at once.
+    @:return: a numpy array of the same shape as v representing the dot product of A and v
     """
     N = len(iA) - 1
-    res = np.zeros(N, dtype=complex)
-    for i in range(N):
-        res[i] = np.dot(sA[iA[i]:iA[i+1]], v[jA[iA[i]:iA[i+1]]])
+    v = np.asarray(v)
+    res = np.zeros((N,) + v.shape[1:], dtype=np.result_type(sA, v))
+    if len(sA) == 0:
+        return res
+    # One gather of the elements of v, one product and the sum of the products of each (non-empty) line
+    prod = sA.reshape((-1,) + (1,) * (v.ndim - 1)) * v[jA]
+    lines = iA[:-1] < iA[1:]
+    res[lines] = np.add.reduceat(prod, iA[:-1][lines])
     return res
 
 
-def csrGMRES(sA, iA, jA, b, rtol, prec, max_iter=300):
+def csrGMRES(sA, iA, jA, b, rtol, prec, max_iter=300, ILU=None, restart=None, deflate=0, ortho='CGS2',
+             side='left', M=None):
     """
     Applies the GMRES algorithm (as described in report) in CSR format on the CSR matrix A represented by sA, iA and jA
     and vector b. It returns an approximation of the solution u : Au = b
+    With a restart length m, GMRES(m) is applied : the Krylov basis is rebuilt from the current residue every m
+    iterations, so that only m+1 vectors are stored.
+    The least squares problem is solved by Givens rotations, updated at each iteration : the rotated right member
+    gives the residue, y is only computed at the end of each cycle.
     @:param sA, iA, jA: 3 1D numpy arrays representing a matrix in CSR format
     @:param b: 1D numpy array of same dimension as matrix A (len(b) == len(iA) - 1)
-    @:param rtol: float scalar representing the convergence criteria
+    @:param rtol: float scalar representing the convergence criteria. With left (or without) preconditionning,
+                  on the residue of the preconditioned system. With right or flexible preconditionning, on the
+                  true residue relative to the norm of b : ||b - Au|| < rtol ||b||.
     @:prec: boolean. If true, preconditionning using ILU(0) is applied else, no preconditionning.
     @:max_iter: integer. Limiting the number of iterations the algorithm. Default is 300.
+    @:ILU: ILUkFactor (or ILUTFactor), ILU decomposition of A used as preconditioner. ILU(0) is computed here if
+           None. It is given to solve several systems with the same matrix or to use another preconditioner.
+    @:restart: integer, restart length m. Default is None : no restart.
+    @:deflate: integer k < m. If positive, the restarts are deflated (GMRES-DR) : the k harmonic Ritz vectors of the
+               smallest harmonic Ritz values are kept in the new basis (see deflated_restart). Default is 0.
+    @:ortho: orthogonalization of the new vectors of the basis. 'CGS2' (default) : classical Gram-Schmidt applied
+             twice, as two products with the whole basis. 'MGS' : modified Gram-Schmidt, vector by vector.
+    @:side: preconditionning. 'left' (default) : GMRES on M^-1 A u = M^-1 b. 'right' : GMRES on A M^-1 (M u) = b.
+            'flexible' (FGMRES) : right preconditionning where M can change at each iteration, the preconditioned
+            vectors are stored (m more vectors). Not available with deflate.
+    @:M: function v -> M^-1 v applying the preconditioner. Default is the ILU(0) preconditioner.
+    @:return: the solution u and the array of the residues at each iteration
     """
-    m = 0
-    V = []
-    H = np.zeros((max_iter+1, max_iter), dtype=complex)
-
-    if prec:
-        sILU, iILU, jILU = csrILU0(sA, iA, jA)      # Computing ILU(0) decomposition
-        r = csrLUsolve(sILU, iILU, jILU, b)         # Initial residue
-        beta = np.linalg.norm(r)
-        V.append(r / beta)                          # First vector in base
-
-    else:
-        beta = np.linalg.norm(b)
-        V.append(b / beta)                          # First vector in base
-
+    N = len(b)
+    m = max_iter if restart is None else min(restart, max_iter)
+    if side == 'flexible' and deflate > 0:
+        raise ValueError('deflated restarts are not available with flexible preconditionning')
+    if prec and M is None:
+        if ILU is None:
+            ILU = ILUkFactor(sA, iA, jA)            # Computing ILU(0) decomposition
+        M = ILU.solve
+    left = prec and side == 'left'
+    right = prec and side != 'left'
+
+    def operator(v, j):
+        # M^-1 A v with left preconditionning, A M^-1 v with right preconditionning, A v without
+        if left:
+            return M(csrMult(sA, iA, jA, v))
+        if right:
+            z = M(v)
+            if side == 'flexible':
+                Z[j] = z
+            return csrMult(sA, iA, jA, z)
+        return csrMult(sA, iA, jA, v)
+
+    def residue(u):
+        # residue of the system solved by GMRES : M^-1 (b - Au) with left preconditionning, b - Au else
+        r = b - csrMult(sA, iA, jA, u)
+        return M(r) if left else r
+
+    V = np.zeros((m+1, N), dtype=complex)           # Krylov basis, one vector per line
+    Z = np.zeros((m, N), dtype=complex) if right and side == 'flexible' else None
+    H = np.zeros((m+1, m), dtype=complex)
+    c = np.zeros(m+1, dtype=complex)                # Right member of the least squares problem
+    u = np.zeros(N, dtype=complex)
+
+    # QR decomposition of H by Givens rotations : R = G_j ... G_k Q0^* H and g = G_j ... G_k Q0^* c
+    R = np.zeros((m+1, m), dtype=complex)
+    g = np.zeros(m+1, dtype=complex)
+    cs = np.zeros(m, dtype=complex)
+    sn = np.zeros(m, dtype=complex)
+
+    r = M(b) if left else np.array(b, dtype=complex)   # Initial residue
+    beta = np.linalg.norm(r)
+    if beta == 0:
+        return u, np.array([beta])
+    V[0] = r / beta                                 # First vector in base
+    c[0] = beta
     res = [beta]
+    tol = rtol * np.linalg.norm(b) if right else rtol
+
+    k = 0                                           # Number of vectors kept by the last restart
+    it = 0
+    breakdown = False
+    while True:
+        # The k first columns of H kept by a deflated restart are full : they are decomposed at once by Q0
+        g[:] = c
+        if k > 0:
+            Q0, R[:k+1, :k] = np.linalg.qr(H[:k+1, :k], mode='complete')
+            g[:k+1] = np.dot(Q0.conj().T, c[:k+1])
+
+        for j in range(k, m):
+            # Arnoldi iteration
+            w = operator(V[j], j)
+            if ortho == 'MGS':
+                for i in range(j+1):
+                    H[i, j] = np.dot(V[i].conj(), w)
+                    w -= H[i, j] * V[i]
+            else:
+                # the second pass corrects the loss of orthogonality of the first one
+                for _ in range(2):
+                    h = np.dot(V[:j+1], w.conj()).conj()
+                    w -= np.dot(h, V[:j+1])
+                    H[:j+1, j] += h
+
+            H[j+1, j] = np.linalg.norm(w)
+            # happy breakdown : the Krylov space is invariant and contains the exact solution
+            breakdown = H[j+1, j] <= np.finfo(float).eps * np.linalg.norm(H[:j+2, j])
+            if not breakdown:
+                V[j+1] = w / H[j+1, j]
+
+            # Applying the previous rotations to the new column of H
+            col = H[:j+2, j].copy()
+            if k > 0:
+                col[:k+1] = np.dot(Q0.conj().T, col[:k+1])
+            for i in range(k, j):
+                col[i], col[i+1] = cs[i].conj() * col[i] + sn[i].conj() * col[i+1], -sn[i] * col[i] + cs[i] * col[i+1]
+
+            # New rotation, cancelling H[j+1, j]
+            rho = np.sqrt(abs(col[j])**2 + abs(col[j+1])**2)
+            cs[j], sn[j] = col[j] / rho, col[j+1] / rho
+            R[:j, j] = col[:j]
+            R[j, j] = rho
+            g[j], g[j+1] = cs[j].conj() * g[j], -sn[j] * g[j]
+
+            newres = abs(g[j+1])
+            res.append(newres)
+            it += 1
+
+            if newres < tol or it >= max_iter or breakdown:     # If the algorithm has converged, we stop it
+                break
+
+        # Finding y to minimise residue and computing solution
+        y = scipy.linalg.solve_triangular(R[:j+1, :j+1], g[:j+1])
+        if side == 'flexible' and right:
+            u += np.dot(y, Z[:j+1])
+        elif right:
+            u += M(np.dot(y, V[:j+1]))
+        else:
+            u += np.dot(y, V[:j+1])
 
-    while m < max_iter:
-        # Arnoldi iteration
-        if prec:
-            w = csrLUsolve(sILU, iILU, jILU, csrMult(sA, iA, jA, V[m]))
+        converged = newres < tol
+        if converged and right:
+            # the residue of the least squares problem is only an estimate of the true residue
+            converged = np.linalg.norm(residue(u)) < tol
+        if converged or breakdown or it >= max_iter:
+            break
+
+        # Restart
+        if deflate > 0 and newres >= tol:
+            k = deflated_restart(V, H, c, y, deflate)
         else:
-            w = csrMult(sA, iA, jA, V[m])
+            r = residue(u)
+            beta = np.linalg.norm(r)
+            H[:] = 0
+            V[0] = r / beta
+            c[:] = 0
+            c[0] = beta
+            k = 0
 
-        for i in range(m+1):
-            H[i, m] = np.dot(V[i].conj(), w)
-            w -= H[i][m] * V[i]
+    return u, np.array(res)
 
-        H[m+1, m] = np.linalg.norm(w)
-        V.append(w / H[m+1, m])
 
-        vec = np.zeros(m+2, dtype=complex)
-        vec[0] = beta
+def csrGMRESPreconditioner(sA, iA, jA, inner_iter=10, ILU=None):
+    """
+    Preconditioner made of a few iterations of GMRES on A (with ILU(0) preconditionning if ILU is given), to use with
+    flexible preconditionning : csrGMRES(..., side='flexible', M=csrGMRESPreconditioner(sA, iA, jA)).
+    @:param sA, iA, jA: 3 1D numpy arrays representing a matrix in CSR format
+    @:param inner_iter: integer, number of iterations of the inner GMRES
+    @:param ILU: ILUkFactor (or ILUTFactor), preconditioner of the inner GMRES. Default is None : no preconditionning.
+    @:return: a function v -> approximation of A^-1 v
+    """
+    def M(v):
+        return csrGMRES(sA, iA, jA, v, 0, ILU is not None, max_iter=inner_iter, ILU=ILU, side='right')[0]
+    return M
 
-        # Finding y to minimise residue
-        y = QRsolve(H[:m+2, :m+1], vec)
-        newres = np.linalg.norm(np.dot(H[:m+2, :m+1], y) - vec)
-        res.append(newres)
 
-        if newres < rtol:                           # If the algorithm has converged, we stop it
-            m += 1
+def deflated_restart(V, H, c, y, k):
+    """
+    Restart of GMRES-DR : the new basis is made of the k harmonic Ritz vectors of the last cycle associated to the
+    smallest harmonic Ritz values, which slow down the convergence of GMRES(m), and of the residue.
+    The next cycle then starts with k columns of the Hessenberg matrix (full) already known.
+    @:param V: 2D numpy array (m+1, N), Krylov basis of the last cycle (one vector per line)
+    @:param H: 2D numpy array (m+1, m), Hessenberg matrix of the last cycle
+    @:param c: 1D numpy array (m+1), right member of the least squares problem of the last cycle
+    @:param y: 1D numpy array (m), solution of the least squares problem of the last cycle
+    @:param k: integer < m, number of harmonic Ritz vectors kept
+    @:return: k. V[:k+1], H[:k+1, :k] and c are updated in place for the next cycle.
+    """
+    m = H.shape[1]
+
+    # Harmonic Ritz pairs : eigenpairs of H_m + |h_m+1,m|^2 H_m^-* e_m e_m^T
+    em = np.zeros(m)
+    em[-1] = 1
+    f = np.linalg.solve(H[:m, :m].conj().T, em)
+    theta, G = np.linalg.eig(H[:m, :m] + abs(H[m, m-1])**2 * np.outer(f, em))
+    G = G[:, np.argsort(np.abs(theta))[:k]]
+
+    # Orthonormal basis P of the harmonic Ritz vectors and of the residue of the least squares problem
+    rs = c - np.dot(H, y)
+    P = np.zeros((m+1, k+1), dtype=complex)
+    P[:m, :k] = G
+    P[:, k] = rs
+    P, _ = np.linalg.qr(P)
+
+    Hk = np.dot(P.conj().T, np.dot(H, P[:m, :k]))
+    V[:k+1] = np.dot(P.T, V)
+    H[:] = 0
+    H[:k+1, :k] = Hk
+    c[:] = 0
+    c[:k+1] = np.dot(P.conj().T, rs)
+    return k
+
+
+def csrCG(sA, iA, jA, b, rtol, M=None, max_iter=1000, cocg=False):
+    """
+    Applies the preconditioned conjugate gradient on the CSR matrix A represented by sA, iA and jA, which must be
+    hermitian (symmetric if real) positive definite. The arithmetic is real if A and b are real.
+    With cocg, the conjugate orthogonal conjugate gradient (COCG) is applied instead, for complex symmetric matrices
+    (A^T = A, as in the harmonic case) : the inner product u^* v is replaced by the bilinear form u^T v.
+    @:param sA, iA, jA: 3 1D numpy arrays representing a matrix in CSR format
+    @:param b: 1D numpy array of same dimension as matrix A (len(b) == len(iA) - 1)
+    @:param rtol: float scalar, convergence criteria on the residue relative to b : ||b - Au|| < rtol ||b||
+    @:param M: function v -> M^-1 v applying a hermitian positive definite preconditioner (the solve method of an
+               AMGPreconditioner for instance). Default is None : no preconditionning.
+    @:param max_iter: integer. Limiting the number of iterations the algorithm. Default is 1000.
+    @:param cocg: boolean, if True COCG is applied (the preconditioner must be complex symmetric). Default is False.
+    @:return: the solution u and the array of the residues at each iteration
+    """
+    dot = np.dot if cocg else np.vdot
+    dtype = np.result_type(sA, b)
+    u = np.zeros(len(b), dtype=dtype)
+    r = np.array(b, dtype=dtype)
+    z = M(r) if M is not None else r
+    d = z.copy()
+    rz = dot(r, z)
+    tol = rtol * np.linalg.norm(b)
+    res = [np.linalg.norm(r)]
+
+    for it in range(max_iter):
+        if res[-1] < tol:
             break
-        m += 1
+        Ad = csrMult(sA, iA, jA, d)
+        alpha = rz / dot(d, Ad)
+        u += alpha * d
+        r -= alpha * Ad
+        res.append(np.linalg.norm(r))
 
-    # Computing solution
-    u = np.dot(y, V[:m])
+        z = M(r) if M is not None else r
+        rz, rz_old = dot(r, z), rz
+        d = z + (rz / rz_old) * d
 
     return u, np.array(res)
 
+
+class AMGPreconditioner:
+    """
+    Algebraic multigrid preconditioner (smoothed aggregation) of a matrix A in CSR format, made for the scalar
+    Laplacians of the static problems (symmetric positive definite, with jumps of mur). It has a method solve(b)
+    applying one V-cycle, like the ILU factors, and can be given to csrGMRES (as ILU) or to csrCG (as M).
+    The hierarchy is built once :
+        - the nodes are grouped in aggregates of strongly connected nodes (see amg_aggregate),
+        - the prolongation P is the piecewise constant interpolation on the aggregates, smoothed by a Jacobi step,
+        - the coarse matrix is P^T A P, and so on until max_coarse unknowns, solved by a LU decomposition.
+          If the aggregation stops reducing the size (or max_levels is reached) before, the coarsest level is too
+          large for a dense LU : coarse_sweeps sweeps of damped Jacobi are applied on it instead.
+    The smoother is the damped Jacobi method, applied before and after the coarse correction (symmetric V-cycle).
+    """
+    def __init__(self, sA, iA, jA, theta=0.08, max_coarse=200, max_levels=10, sweeps=1, coarse_sweeps=10):
+        self.N = len(iA) - 1
+        self.singular = False
+        self.sweeps = sweeps
+        self.coarse_sweeps = coarse_sweeps
+        self.levels = []
+
+        A = scipy.sparse.csr_matrix((sA, jA, iA), shape=(self.N, self.N))
+        A.sort_indices()
+        while A.shape[0] > max_coarse and len(self.levels) < max_levels - 1:
+            T = amg_aggregate(A, theta)
+            if T.shape[1] >= A.shape[0]:
+                break
+            wdinv = amg_jacobi(A)
+            # P = (I - 4/3 / rho D^-1 A) T
+            P = (T - scipy.sparse.diags(wdinv) @ (A @ T)).tocsr()
+            self.levels.append((A.data, A.indptr, A.indices, wdinv, P))
+            A = (P.T @ A @ P).tocsr()
+            A.sort_indices()
+
+        if A.shape[0] <= max_coarse:
+            self.coarse = scipy.linalg.lu_factor(A.toarray())
+        else:
+            self.coarse = (A.data, A.indptr, A.indices, amg_jacobi(A))
+
+    def solve(self, b):
+        """
+        Applies one V-cycle to b.
+        @:param b: numpy 1D (or 2D, one right member per column) array
+        @:return: the approximation of A^-1 b
+        """
+        return self.cycle(0, np.asarray(b))
+
+    def cycle(self, level, b):
+        if level == len(self.levels):
+            if len(self.coarse) == 2:
+                return scipy.linalg.lu_solve(self.coarse, b)
+            # damped Jacobi from 0, a polynomial in D^-1 A : the V-cycle stays symmetric
+            sA, iA, jA, wdinv = self.coarse
+            wdinv = wdinv.reshape((-1,) + (1,) * (b.ndim - 1))
+            x = wdinv * b
+            for _ in range(self.coarse_sweeps - 1):
+                x = x + wdinv * (b - csrMult(sA, iA, jA, x))
+            return x
+        sA, iA, jA, wdinv, P = self.levels[level]
+        wdinv = wdinv.reshape((-1,) + (1,) * (b.ndim - 1))
+
+        # pre-smoothing from 0
+        x = wdinv * b
+        for _ in range(self.sweeps - 1):
+            x = x + wdinv * (b - csrMult(sA, iA, jA, x))
+        # coarse grid correction
+        x = x + P @ self.cycle(level + 1, P.T @ (b - csrMult(sA, iA, jA, x)))
+        # post-smoothing
+        for _ in range(self.sweeps):
+            x = x + wdinv * (b - csrMult(sA, iA, jA, x))
+        return x
+
+
+def amg_jacobi(A):
+    """
+    Returns the inverse of the diagonal of A damped by 4/3 / rho, rho being the spectral radius of D^-1 A estimated
+    by a few power iterations : the weights of the damped Jacobi smoother and of the smoothing of the prolongation.
+    @:param A: scipy sparse matrix (CSR)
+    @:return: 1D numpy array
+    """
+    dinv = 1 / A.diagonal()
+    v = np.random.default_rng(0).random(A.shape[0])
+    for _ in range(15):
+        w = dinv * (A @ v)
+        rho = np.linalg.norm(w) / np.linalg.norm(v)
+        v = w
+    return dinv * (4 / (3 * rho))
+
+
+def amg_aggregate(A, theta):
+    """
+    Groups the nodes of A in aggregates (standard aggregation) : the node j is strongly connected to i if
+    |a_ij| >= theta sqrt(|a_ii a_jj|). A node whose strong neighbours are all free forms an aggregate with them,
+    the remaining nodes join the aggregate of one of their strong neighbours or form their own aggregate.
+    @:param A: scipy sparse matrix in CSR format
+    @:param theta: float, strength threshold
+    @:return: the tentative prolongation T (N x number of aggregates) in CSR format, T[i, a] = 1 if i is in a,
+              its columns being normalized
+    """
+    N = A.shape[0]
+    A = A.tocoo()
+    d = np.abs(A.diagonal())
+    strong = (A.row != A.col) & (np.abs(A.data) >= theta * np.sqrt(d[A.row] * d[A.col]))
+    S = scipy.sparse.csr_matrix((np.ones(np.count_nonzero(strong)), (A.row[strong], A.col[strong])), shape=(N, N))
+    ptr, cols = S.indptr.tolist(), S.indices.tolist()
+
+    aggregate = [-1] * N
+    count = 0
+    # first pass : the nodes with free neighbours
+    for i in range(N):
+        neighbours = cols[ptr[i]:ptr[i+1]]
+        if aggregate[i] == -1 and all(aggregate[j] == -1 for j in neighbours):
+            aggregate[i] = count
+            for j in neighbours:
+                aggregate[j] = count
+            count += 1
+    # second pass : the remaining nodes join a neighbouring aggregate (of the first pass)
+    first = list(aggregate)
+    for i in range(N):
+        if aggregate[i] == -1:
+            for j in cols[ptr[i]:ptr[i+1]]:
+                if first[j] != -1:
+                    aggregate[i] = first[j]
+                    break
+    # last pass : the isolated nodes form their own aggregates
+    for i in range(N):
+        if aggregate[i] == -1:
+            aggregate[i] = count
+            count += 1
+
+    aggregate = np.array(aggregate)
+    size = np.bincount(aggregate, minlength=count)
+    return scipy.sparse.csr_matrix((1 / np.sqrt(size[aggregate]), (np.arange(N), aggregate)), shape=(N, count))
@@ -4,13 +4,314 @@ import scipy.sparse.linalg
 import gmsh
 import time
 import sys
+import os
+import shutil
+import collections
 
 from mysolve import *
 
 DEBUG = True
-
-
-def ndtfun(gap, ref, freq, vel, mur, run, copy, SolverType, rtol, prec):
+COND = True     # compute cond(A), requires a dense copy of A
+COND_MAX_N = 2000   # cond(A) costs O(N^3) : it is skipped (None) above this number of unknowns
+
+# Integration points and basis functions on the reference element only depend on the element type
+# and the integration rule : they are asked to gmsh once and kept across entities, groups and ndtfun calls.
+refElements = {}
+
+
+def reference_element(elementType, rule):
+    """
+    Returns the integration points uvw, their weights (g), the basis functions sf (g,n)
+    and their gradients dsfdu (g,n,u) on the reference element of type elementType.
+    """
+    key = (elementType, rule)
+    if key not in refElements:
+        uvw, weights = gmsh.model.mesh.getIntegrationPoints(elementType, rule)
+        weights = np.array(weights)
+        numGaussPoints = weights.shape[0]
+        numcomp, sf = gmsh.model.mesh.getBasisFunctions(elementType, uvw, 'Lagrange')[:2]
+        sf = np.array(sf).reshape((numGaussPoints,-1))
+        numcomp, dsfdu = gmsh.model.mesh.getBasisFunctions(elementType, uvw, 'GradLagrange')[:2]
+        #remove useless dsfdw
+        dsfdu = np.array(dsfdu).reshape((numGaussPoints,sf.shape[1],3))[:,:,:-1]
+        refElements[key] = (uvw, weights, sf, dsfdu)
+    return refElements[key]
+
+
+# Meshes used by ndtfun, keyed by the geometry parameters (gap, ref) or by the path of the .msh file they
+# were read from, the least recently used first. A mesh entry also keeps the blocks of the system matrix
+# once they are assembled.
+meshes = collections.OrderedDict()
+MESH_CACHE_SIZE = 8     # number of meshes kept in memory
+MESH_CACHE_DIR = None   # directory of the snapshots of the generated meshes, None to only keep them in memory
+MSH_SNAPSHOTS = False   # write a snapshot next to the .msh files read by ndtfun
+
+
+def read_mesh(rule):
+    """
+    Copies the mesh of the current gmsh model in numpy arrays : the node tags and coordinates (N,3) and,
+    for each (physical group, entity, element type), the element connectivity enode (e,n).
+    The reference elements of the 2D element types for the integration rule are stored along.
+    """
+    tags, coords, _ = gmsh.model.mesh.getNodes()
+    mesh = {'nodeTags': np.array(tags, dtype=int), 'coords': np.array(coords).reshape((-1,3)),
+            'blocks': [], 'refElements': {}}
+    for dimGroup, tagGroup in gmsh.model.getPhysicalGroups():
+        for tagEntity in gmsh.model.getEntitiesForPhysicalGroup(dimGroup, tagGroup):
+            for elementType in gmsh.model.mesh.getElementTypes(dimGroup, tagEntity):
+                vTags, vNodes = gmsh.model.mesh.getElementsByType(elementType, tagEntity)
+                enode = np.array(vNodes, dtype=int).reshape((len(vTags),-1))
+                mesh['blocks'].append((dimGroup, tagGroup, tagEntity, elementType, enode))
+                if dimGroup == 2:
+                    mesh['refElements'][(elementType, rule)] = reference_element(elementType, rule)
+    return mesh
+
+
+def save_snapshot(path, mesh):
+    """
+    Saves a mesh in a binary snapshot : a directory of .npy files that load_snapshot memory-maps, so that
+    several processes share a single read-only copy of the mesh. It holds the node tags and coordinates,
+    the connectivity of each element block, the reference elements and, once the nodes are numbered,
+    the Dirichlet nodes and node2unknown.
+    The snapshot is written in a temporary directory which is then renamed, so it is never read half-written.
+    """
+    arrays = {'nodeTags': mesh['nodeTags'], 'coords': mesh['coords'],
+              'blockInfo': np.array([block[:4] for block in mesh['blocks']], dtype=int).reshape((-1,4)),
+              'refKeys': np.array([[str(key[0]), key[1]] for key in mesh['refElements']], dtype=str).reshape((-1,2))}
+    for i, block in enumerate(mesh['blocks']):
+        arrays['enode%d' % i] = block[4]
+    for i, ref in enumerate(mesh['refElements'].values()):
+        for name, value in zip(('uvw', 'weights', 'sf', 'dsfdu'), ref):
+            arrays['ref%s%d' % (name, i)] = value
+    if 'node2unknown' in mesh:
+        arrays['dirichletNodes'] = mesh['dirichletNodes']
+        arrays['node2unknown'] = mesh['node2unknown']
+
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    for name, value in arrays.items():
+        np.save(os.path.join(tmp, name + '.npy'), np.asarray(value))
+    if os.path.isdir(path):
+        shutil.rmtree(path) # outdated snapshot
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp)  # another process has just written it
+
+
+def load_snapshot(path):
+    """
+    Loads a mesh saved by save_snapshot, its arrays are memory-mapped (read-only).
+    Its reference elements are added to refElements.
+    """
+    def load(name):
+        return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+    mesh = {'nodeTags': load('nodeTags'), 'coords': load('coords'), 'blocks': [], 'refElements': {}}
+    for i, (dim, tagGroup, tagEntity, elementType) in enumerate(load('blockInfo')):
+        mesh['blocks'].append((int(dim), int(tagGroup), int(tagEntity), int(elementType), load('enode%d' % i)))
+    for i, (elementType, rule) in enumerate(load('refKeys')):
+        key = (int(elementType), str(rule))
+        ref = tuple(load('ref%s%d' % (name, i)) for name in ('uvw', 'weights', 'sf', 'dsfdu'))
+        mesh['refElements'][key] = refElements.setdefault(key, ref)
+    if os.path.exists(os.path.join(path, 'node2unknown.npy')):
+        mesh['dirichletNodes'] = load('dirichletNodes')
+        mesh['node2unknown'] = load('node2unknown')
+    return mesh
+
+
+def snapshot_path(key):
+    # the snapshots of the generated meshes are in MESH_CACHE_DIR, the one of a .msh file is next to it
+    if isinstance(key, tuple):
+        if MESH_CACHE_DIR is None:
+            return None
+        return os.path.join(MESH_CACHE_DIR, 'ndt_gap%g_ref%g.snapshot' % key)
+    return os.path.splitext(key)[0] + '.snapshot' if MSH_SNAPSHOTS else None
+
+
+def has_snapshot(key):
+    path = snapshot_path(key)
+    if path is None or not os.path.isdir(path):
+        return False
+    # the snapshot of a .msh file is outdated if the file was modified after it
+    return isinstance(key, tuple) or os.path.getmtime(path) >= os.path.getmtime(key)
+
+
+def cached_mesh(key):
+    """
+    Returns the mesh cached for key (in memory, then as a snapshot on disk) or None.
+    """
+    if key in meshes:
+        meshes.move_to_end(key)
+        return meshes[key]
+    if has_snapshot(key):
+        return store_mesh(key, load_snapshot(snapshot_path(key)))
+    return None
+
+
+def store_mesh(key, mesh):
+    """
+    Adds a mesh to the cache, evicting the least recently used one if the cache is full.
+    """
+    meshes[key] = mesh
+    meshes.move_to_end(key)
+    while len(meshes) > MESH_CACHE_SIZE:
+        meshes.popitem(last=False)
+    return mesh
+
+
+# Number of nodes of the element types of the MSH format
+MSH_NODES_PER_ELEMENT = {1: 2, 2: 3, 3: 4, 4: 4, 5: 8, 6: 6, 7: 5, 8: 3, 9: 6, 10: 9, 11: 10, 15: 1,
+                         16: 8, 17: 20, 18: 15, 19: 13, 20: 9, 21: 10, 26: 4, 27: 5, 28: 6, 29: 20, 30: 35, 31: 56}
+
+
+def builtin_reference_element(elementType, rule):
+    """
+    Reference elements given by gmsh, built in so that a mesh file can be assembled without gmsh.
+    Only the 3-node triangle with the 'Gauss2' rule (used by ndtfun) is available, None otherwise.
+    """
+    if (elementType, rule) != (2, 'Gauss2'):
+        return None
+    uvw = np.array([1/6, 1/6, 0, 2/3, 1/6, 0, 1/6, 2/3, 0])
+    weights = np.array([1/6, 1/6, 1/6])
+    u, v = uvw[0::3], uvw[1::3]
+    sf = np.stack([1-u-v, u, v], axis=1)
+    dsfdu = np.tile(np.array([[-1., -1.], [1., 0.], [0., 1.]]), (3, 1, 1))
+    return uvw, weights, sf, dsfdu
+
+
+def read_msh(path, rule):
+    """
+    Reads a mesh file in the MSH 4.1 format (ASCII or binary) with numpy only, gmsh is not needed.
+    Returns the same arrays as read_mesh, along with the physical names : mesh['physicalNames'][(dim, tag)].
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    # splits the file in its sections $Name ... $EndName
+    sections = {}
+    pos = 0
+    while True:
+        pos = data.find(b'$', pos)
+        if pos < 0:
+            break
+        eol = data.find(b'\n', pos)
+        name = data[pos+1:eol].strip().decode()
+        end = data.find(b'\n$End' + name.encode(), eol)
+        sections[name] = data[eol+1:end+1]
+        pos = data.find(b'\n', end+1)
+
+    version, fileType, dataSize = sections['MeshFormat'].split(b'\n')[0].split()
+    if not version.startswith(b'4.1'):
+        raise ValueError('Only the MSH 4.1 format can be read, not %s' % version.decode())
+    binary = fileType == b'1'
+
+    if binary:
+        # the header is followed by the integer 1, written in the endianness of the file
+        one = sections['MeshFormat'].split(b'\n', 1)[1][:4]
+        endian = '<' if np.frombuffer(one, dtype='<i4')[0] == 1 else '>'
+        isize = np.dtype(endian + 'i4')
+        usize = np.dtype(endian + 'u%d' % int(dataSize))
+        dsize = np.dtype(endian + 'f8')
+
+        def reader(buffer):
+            # sequential reading of the binary data : read(dtype, count)
+            offset = [0]
+            def read(dtype, count=1):
+                values = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset[0])
+                offset[0] += dtype.itemsize * count
+                return values
+            return read
+    else:
+        isize = usize = dsize = np.dtype(float)
+
+        def reader(buffer):
+            # in ASCII, all the numbers of a section are parsed at once
+            tokens = np.array(buffer.split(), dtype=float)
+            offset = [0]
+            def read(dtype, count=1):
+                values = tokens[offset[0]:offset[0]+count]
+                offset[0] += count
+                return values
+            return read
+
+    physicalNames = {}
+    if 'PhysicalNames' in sections:
+        for line in sections['PhysicalNames'].decode().split('\n')[1:]:
+            if line.strip():
+                dim, tag, name = line.split(maxsplit=2)
+                physicalNames[(int(dim), int(tag))] = name.strip().strip('"')
+
+    # physical tags of the entities
+    entityGroups = {}
+    read = reader(sections['Entities'])
+    counts = read(usize, 4).astype(int)
+    for dim in range(4):
+        for i in range(counts[dim]):
+            tag = int(read(isize)[0])
+            read(dsize, 3 if dim == 0 else 6)
+            groups = read(isize, int(read(usize)[0])).astype(int)
+            entityGroups[(dim, tag)] = groups
+            if dim > 0:
+                read(isize, int(read(usize)[0]))
+
+    read = reader(sections['Nodes'])
+    numBlocks, numNodes = read(usize, 4).astype(int)[:2]
+    nodeTags = np.zeros(numNodes, dtype=int)
+    coords = np.zeros((numNodes, 3))
+    start = 0
+    for i in range(numBlocks):
+        dim, tag, parametric = (int(value) for value in read(isize, 3))
+        n = int(read(usize)[0])
+        nodeTags[start:start+n] = read(usize, n)
+        coords[start:start+n] = read(dsize, n*(3+parametric*dim)).reshape((n,-1))[:,:3]
+        start += n
+
+    read = reader(sections['Elements'])
+    numBlocks = int(read(usize, 4)[0])
+    elements = {}
+    for i in range(numBlocks):
+        dim, tag, elementType = (int(value) for value in read(isize, 3))
+        n = int(read(usize)[0])
+        numElementNodes = MSH_NODES_PER_ELEMENT[elementType]
+        enode = read(usize, n*(1+numElementNodes)).reshape((n,-1))[:,1:].astype(int)
+        elements.setdefault((dim, tag), []).append((elementType, enode))
+
+    # element blocks ordered as in read_mesh : by physical group, then by entity
+    mesh = {'nodeTags': nodeTags, 'coords': coords, 'blocks': [], 'refElements': {},
+            'physicalNames': physicalNames}
+    groups = sorted(set((dim, int(group)) for (dim, tag), vGroups in entityGroups.items() for group in vGroups))
+    for dimGroup, tagGroup in groups:
+        for (dim, tagEntity), vGroups in entityGroups.items():
+            if dim != dimGroup or tagGroup not in vGroups:
+                continue
+            for elementType, enode in elements.get((dim, tagEntity), []):
+                mesh['blocks'].append((dimGroup, tagGroup, tagEntity, elementType, enode))
+                key = (elementType, rule)
+                if dimGroup == 2 and key not in mesh['refElements']:
+                    if key not in refElements and builtin_reference_element(*key) is not None:
+                        refElements[key] = builtin_reference_element(*key)
+                    mesh['refElements'][key] = reference_element(*key)
+    return mesh
+
+
+def inverse_2x2(dxdu):
+    """
+    Closed-form inverse and determinant of a stack of 2x2 matrices dxdu (...,2,2),
+    avoids the generic (and much slower) np.linalg.inv on the (e,g,2,2) Jacobians.
+    """
+    det = dxdu[...,0,0]*dxdu[...,1,1] - dxdu[...,0,1]*dxdu[...,1,0]
+    inv = np.empty(dxdu.shape)
+    inv[...,0,0] =  dxdu[...,1,1]/det
+    inv[...,0,1] = -dxdu[...,0,1]/det
+    inv[...,1,0] = -dxdu[...,1,0]/det
+    inv[...,1,1] =  dxdu[...,0,0]/det
+    return inv, det
+
+
+def ndtfun(gap, ref, freq, vel, mur, run, copy, SolverType, rtol, prec, msh=None):
+    # If msh is the path of a .msh file (MSH 4.1), the mesh is read from it without gmsh
+    # and gap and ref are not used.
     # This scripts assembles and solves a simple finite element problem
     # using exclusively the python api of Gmsh.
 
@@ -38,6 +339,12 @@ def ndtfun(gap, ref, freq, vel, mur, run, copy, SolverType, rtol, prec):
     COILN = 4       # Physical Surface tag of positive current coil
     COILP = 5       # Physical Surface tag of negative current coil
 
+    # Columns of the assembled blocks of the system matrix
+    KAIR = 0        # stiffness of the regions with nu = 1/mu0
+    KCORE = 1       # stiffness of region CORE, nu = 1/(mur*mu0)
+    MPLATE = 2      # mass matrix of region PLATE
+    CPLATE = 3      # convection matrix of region PLATE for a unit velocity
+
     # Model parameters
     mu0 = 4.e-7*np.pi
     sigma = 5e7     # electric conductivity
@@ -161,122 +468,182 @@ def ndtfun(gap, ref, freq, vel, mur, run, copy, SolverType, rtol, prec):
             exec("print")
         exit(1)
 
-    def solve(freq, vel, mur, SolverType, rtol, prec):
-        jomega = complex(0, 2 * np.pi * freq)
-        mshNodes = np.array(model.mesh.getNodes()[0])
+    def number_nodes(typNodes):
+        # Associate to all mesh nodes a line number in the system matrix
+        # reserving top lines for internal nodes and bottom lines for fixed nodes (boundary nodes).
+        # Unknowns are numbered from 1 in increasing tag order, 0 is left for the tags that do not exist.
+        internal = typNodes == 1 # not fixed
+        fixed = typNodes == 2    # fixed
+        numUnknowns = np.count_nonzero(internal)
+
+        node2unknown = np.zeros(len(typNodes), dtype=np.int32)
+        node2unknown[internal] = np.cumsum(internal)[internal]
+        node2unknown[fixed] = numUnknowns + np.cumsum(fixed)[fixed]
+        return node2unknown
+
+    def invert_numbering(node2unknown):
+        # inverse map, unknown2node[0] is unused
+        nodes = np.nonzero(node2unknown)[0]
+        unknown2node = np.zeros(len(nodes)+1, dtype=np.int32)
+        unknown2node[node2unknown[nodes]] = nodes
+        return unknown2node
+
+    def scatter_add(index, values, size):
+        # res[index[k]] += values[k] for all k at once (repeated indices are summed).
+        # np.bincount only accepts real weights, complex values are summed part by part.
+        if np.iscomplexobj(values):
+            return scatter_add(index, values.real, size) + 1j*scatter_add(index, values.imag, size)
+        return np.bincount(index, weights=values, minlength=size)
+
+    def assemble(mesh):
+        # Assembles the blocks of the system matrix that do not depend on freq, vel and mur :
+        #   A(freq, vel, mur) = Kair/mu0 + Kcore/(mur*mu0) + sigma*jomega*Mplate + sigma*vel*Cplate
+        # All blocks are stored on the sparsity pattern (iA, jA) of A.
+        # Only the mesh arrays are used, gmsh is not needed here.
+        mshNodes = mesh['nodeTags']
         numMeshNodes = len(mshNodes)
         printf('numMeshNodes =', numMeshNodes)
         maxNodeTag = int(np.amax(mshNodes))
         printf('maxNodeTag =', maxNodeTag)
 
 
-        # initializations of global assembly arrays iteratively filled-in during assembly
-        matrowflat = np.array([], dtype=np.int32)
-        matcolflat = np.array([], dtype=np.int32)
-        matflat = np.array([], dtype=np.int32)
-        rhsrowflat = np.array([], dtype=np.int32)
-        rhsflat = np.array([], dtype=np.int32)
+        # The numbering of the nodes only depends on the mesh : it is kept in the mesh (and in its snapshot).
+        if 'node2unknown' not in mesh:
+            # typNodes[tag] = {0,1,2} 0: does not exist, 1:internal node, 2:boundary node
+            typNodes = np.zeros(maxNodeTag+1, dtype=np.int32)
+            typNodes[mshNodes] = 1
+
+            # identify boundary node
+            boundary = [enode.ravel() for dimEntity, tagGroup, tagEntity, elementType, enode in mesh['blocks']
+                        if tagGroup == DIRICHLET0]
+            mesh['dirichletNodes'] = np.unique(np.concatenate(boundary)) if boundary else np.zeros(0, dtype=int)
+            typNodes[mesh['dirichletNodes']] = 2
+            mesh['node2unknown'] = number_nodes(typNodes)
+
+        node2unknown = mesh['node2unknown']
+        unknown2node = invert_numbering(node2unknown)
+        numUnknowns = numMeshNodes - len(mesh['dirichletNodes'])
+        printf('numUnknowns =', numUnknowns)
+        if len(unknown2node) != numMeshNodes+1:
+            errorf('Something went wrong')
+
+        printf('\nDimension of nodes vs unknowns arrays')
+        printf('%mshNodes=',mshNodes.shape)
+        printf('%dirichletNodes=',mesh['dirichletNodes'].shape)
+        printf('%node2unknown=',node2unknown.shape)
+        printf('%unknown2node=',unknown2node.shape)
 
-        # typNodes[tag] = {0,1,2} 0: does not exist, 1:internal node, 2:boundary node
-        # Existing node tags are set to 1 here.
-        # Boundary node tag are identified later.
-        typNodes = np.zeros(maxNodeTag+1, dtype=np.int32)
-        for tagNode in mshNodes:
-            typNodes[tagNode] = 1
+        # node coordinates indexed by node tag
+        xyz = np.zeros((maxNodeTag+1, 3))
+        xyz[mshNodes] = mesh['coords']
 
         # The mesh is iterated over, looping successively (nested loops) over:
         # Physical groups/Geometrical entities/Element types/Elements
-        vGroups = model.getPhysicalGroups()
-        for iGroup in vGroups:
-            dimGroup = iGroup[0] # 1D, 2D or 3D
-            tagGroup = iGroup[1] # the word 'tag' is systematically used instead of 'number'
-            vEntities = model.getEntitiesForPhysicalGroup(dimGroup, tagGroup)
-            for tagEntity in vEntities:
-                dimEntity = dimGroup # FIXME dimEntity should be optional when tagEntity given.
-                vElementTypes = model.mesh.getElementTypes(dimEntity,tagEntity)
-                for elementType in vElementTypes:
-                    vTags, vNodes = model.mesh.getElementsByType(elementType, tagEntity)
-                    numElements = len(vTags)
-                    numGroupNodes = len(vNodes)
-                    enode = np.array(vNodes).reshape((numElements,-1))
-                    numElementNodes = enode.shape[1]
-                    printf('\nIn group', tagGroup, ', numElements = e =', numElements)
-                    printf('numGroupNodes =', numGroupNodes,', numElementNodes = n =', numElementNodes)
-                    printf('%enodes (e,n) =', enode.shape)
-
-                    # Assembly of stiffness matrix for all 2 dimensional elements
-                    # (i.e., triangles or quadrangles)
-                    if dimEntity==2 :
-
-                        uvw,weights = gmsh.model.mesh.getIntegrationPoints(2,"Gauss2")
-                        numcomp, sf = model.mesh.getBasisFunctions(elementType, uvw, 'Lagrange')
-
-                        numGaussPoints = weights.shape[0]
-                        printf('numGaussPoints = g =', numGaussPoints, ', %weights (g) =', weights.shape)
-                        sf = np.array(sf).reshape((numGaussPoints,-1))
-                        printf('%sf (g,n) =', sf.shape)
-                        if sf.shape[1] != numElementNodes:
-                            errorf('Something went wrong')
-                        numcomp, dsfdu = model.mesh.getBasisFunctions(elementType, uvw, 'GradLagrange')
-
-                        #remove useless dsfdw
-                        dsfdu = np.array(dsfdu).reshape((numGaussPoints,numElementNodes,3))[:,:,:-1]
-                        printf('%dsfdu (g,n,u) =', dsfdu.shape)
-
-                        qjac, qdet, qpoint = model.mesh.getJacobians(elementType, uvw, tagEntity)
-                        printf('Gauss integr:',len(qjac),len(qdet),len(qpoint),
-                               '= (9, 1, 3) x',numGaussPoints,'x',numElements)
-                        qdet = np.array(qdet).reshape((numElements,numGaussPoints))
-                        printf('%qdet (e,g) =', qdet.shape)
-                        #remove components of dxdu useless in dimEntity dimensions (here 2D)
-                        dxdu = np.array(qjac).reshape((numElements,numGaussPoints,3,3))[:,:,:-1,:-1]
-                        # jacobien stored by row, so dxdu[i][j] = dxdu_ij = dxi/duj
-                        printf('%dxdu (e,g,x,u)=', dxdu.shape)
-
-                        # material characteristic
-                        if tagGroup == CORE:
-                            nu = complex(1.,0)/(mur*mu0)
-                        else:
-                            nu = complex(1.,0)/mu0
-
-                        # dsdfx = dudx * dsfdu
-                        dudx = np.linalg.inv(dxdu) # dudx[j][k] = dudx_jk = duj/dxk
-                        printf('%dudx (e,g,u,x) =', dudx.shape)
-                        dsfdx  = np.einsum("egxu,gnu->egnx",dudx,dsfdu); # sum over u = dot product
-                        printf('%dsfdx (e,g,n,x) =', dsfdx.shape)
-
-                        # performs the Gauss integration with einsum
-                        localmat = nu * np.einsum("egik,egjk,eg,g->eij", dsfdx, dsfdx, qdet, weights)
-                        printf('%localmat (e,n,n) =', localmat.shape)
-
-                        if tagGroup == PLATE:
-                            localmat += sigma*jomega*np.einsum("gi,gj,eg,g->eij", sf, sf, qdet, weights)
-                            Liesf = np.einsum("egik,k->egi", dsfdx, np.array([vel,0]))
-                            localmat += sigma*np.einsum("gi,egj,eg,g->eij", sf, Liesf, qdet, weights)
-
-                        # The next two lines are rather obscure.
-                        # See explanations at the bottom of the file.
-                        matcol = np.repeat(enode[:,:,None],numElementNodes,axis=2)
-                        matrow = np.repeat(enode[:,None,:],numElementNodes,axis=1)
-
-                        matcolflat = np.append(matcolflat, matcol.flatten())
-                        matrowflat = np.append(matrowflat, matrow.flatten())
-                        matflat = np.append(matflat, localmat.flatten())
-
-                        if tagGroup == COILP or tagGroup == COILN:
-                            if tagGroup == COILP:
-                                load = J
-                            elif tagGroup == COILN:
-                                load = -J
-                            localrhs = load * np.einsum("gn,eg,g->en", sf, qdet, weights)
-                            printf('Check rhs:', np.sum(localrhs), "=", load*CoilSection)
-                            rhsrowflat = np.append(rhsrowflat, enode.flatten())
-                            rhsflat = np.append(rhsflat, localrhs.flatten())
-
-                    # identify boundary node
-                    if tagGroup == DIRICHLET0:
-                        for tagNode in vNodes:
-                            typNodes[tagNode] = 2
+        # (flattened in the list of element blocks of the mesh).
+        # A first pass only counts the number of entries each block adds to the
+        # global assembly arrays, so that those can be allocated once.
+        numMatEntries = 0
+        numRhsEntries = 0
+        for dimEntity, tagGroup, tagEntity, elementType, enode in mesh['blocks']:
+            if dimEntity == 2:
+                numMatEntries += enode.size * enode.shape[1]
+                if tagGroup == COILP or tagGroup == COILN:
+                    numRhsEntries += enode.size
+
+        # global assembly arrays, each element block writes its entries in its own slice
+        # matflat[:,KAIR], matflat[:,KCORE], matflat[:,MPLATE] and matflat[:,CPLATE]
+        # hold the entries of the four blocks of the system matrix.
+        matrowflat = np.zeros(numMatEntries, dtype=np.int32)
+        matcolflat = np.zeros(numMatEntries, dtype=np.int32)
+        matflat = np.zeros((numMatEntries, 4))
+        rhsrowflat = np.zeros(numRhsEntries, dtype=np.int32)
+        rhsflat = np.zeros(numRhsEntries)
+        imat = 0
+        irhs = 0
+
+        for dimEntity, tagGroup, tagEntity, elementType, enode in mesh['blocks']:
+            numElements, numElementNodes = enode.shape
+            numGroupNodes = enode.size
+            printf('\nIn group', tagGroup, ', numElements = e =', numElements)
+            printf('numGroupNodes =', numGroupNodes,', numElementNodes = n =', numElementNodes)
+            printf('%enodes (e,n) =', enode.shape)
+
+            # Assembly of stiffness matrix for all 2 dimensional elements
+            # (i.e., triangles or quadrangles)
+            if dimEntity==2 :
+
+                uvw, weights, sf, dsfdu = reference_element(elementType, Integration)
+
+                numGaussPoints = weights.shape[0]
+                printf('numGaussPoints = g =', numGaussPoints, ', %weights (g) =', weights.shape)
+                printf('%sf (g,n) =', sf.shape)
+                if sf.shape[1] != numElementNodes:
+                    errorf('Something went wrong')
+                printf('%dsfdu (g,n,u) =', dsfdu.shape)
+
+                # Jacobians of the isoparametric mapping at the Gauss points, computed from the node coordinates
+                # (only the x and y components are useful in 2D). They are stored in the same layout as the
+                # ones returned by gmsh.model.mesh.getJacobians (by column) : dxdu[i][j] = dxj/dui
+                dxdu = np.einsum("gnu,enx->egux", dsfdu, xyz[enode][:,:,:-1])
+                printf('%dxdu (e,g,x,u)=', dxdu.shape)
+
+                # dsdfx = dudx * dsfdu
+                dudx, qdet = inverse_2x2(dxdu) # dudx[j][k] = dudx_jk = duj/dxk
+                qdet = np.abs(qdet)
+                printf('%qdet (e,g) =', qdet.shape)
+                printf('%dudx (e,g,u,x) =', dudx.shape)
+
+                if elementType == 2:
+                    # 3-node triangles : dudx and dsfdu are constant on each element,
+                    # the gradients are computed at the first Gauss point only
+                    # and the integration reduces to (sum of the weights) * area factor.
+                    dsfdx0 = np.matmul(dsfdu[0], np.swapaxes(dudx[:,0], 1, 2)) # (e,n,x)
+                    dsfdx = np.broadcast_to(dsfdx0[:,None], (numElements,numGaussPoints,numElementNodes,2))
+                    printf('%dsfdx (e,g,n,x) =', dsfdx.shape)
+                    localmat = (qdet[:,0] * np.sum(weights))[:,None,None] * \
+                               np.matmul(dsfdx0, np.swapaxes(dsfdx0, 1, 2))
+                else:
+                    dsfdx  = np.einsum("egxu,gnu->egnx",dudx,dsfdu); # sum over u = dot product
+                    printf('%dsfdx (e,g,n,x) =', dsfdx.shape)
+
+                    # performs the Gauss integration with einsum
+                    localmat = np.einsum("egik,egjk,eg,g->eij", dsfdx, dsfdx, qdet, weights)
+                printf('%localmat (e,n,n) =', localmat.shape)
+
+                # The next two lines are rather obscure.
+                # See explanations at the bottom of the file.
+                matcol = np.repeat(enode[:,:,None],numElementNodes,axis=2)
+                matrow = np.repeat(enode[:,None,:],numElementNodes,axis=1)
+
+                numLocalEntries = localmat.size
+                matcolflat[imat:imat+numLocalEntries] = matcol.flatten()
+                matrowflat[imat:imat+numLocalEntries] = matrow.flatten()
+
+                # material characteristic, nu = 1/(mur*mu0) in the core and 1/mu0 elsewhere
+                if tagGroup == CORE:
+                    matflat[imat:imat+numLocalEntries, KCORE] = localmat.flatten()
+                else:
+                    matflat[imat:imat+numLocalEntries, KAIR] = localmat.flatten()
+
+                # mass and convection (for a unit velocity along x) terms in the plate
+                if tagGroup == PLATE:
+                    localmass = np.einsum("gi,gj,eg,g->eij", sf, sf, qdet, weights)
+                    Liesf = dsfdx[:,:,:,0]
+                    localconv = np.einsum("gi,egj,eg,g->eij", sf, Liesf, qdet, weights)
+                    matflat[imat:imat+numLocalEntries, MPLATE] = localmass.flatten()
+                    matflat[imat:imat+numLocalEntries, CPLATE] = localconv.flatten()
+                imat += numLocalEntries
+
+                if tagGroup == COILP or tagGroup == COILN:
+                    if tagGroup == COILP:
+                        load = J
+                    elif tagGroup == COILN:
+                        load = -J
+                    localrhs = load * np.einsum("gn,eg,g->en", sf, qdet, weights)
+                    printf('Check rhs:', np.sum(localrhs), "=", load*CoilSection)
+                    rhsrowflat[irhs:irhs+enode.size] = enode.flatten()
+                    rhsflat[irhs:irhs+enode.size] = localrhs.flatten()
+                    irhs += enode.size
 
         printf('\nDimension of arrays built by the assembly process')
         printf('%colflat = ', matcolflat.shape)
@@ -285,50 +652,57 @@ def ndtfun(gap, ref, freq, vel, mur, run, copy, SolverType, rtol, prec):
         printf('%rhsrowflat = ', rhsrowflat.shape)
         printf('%rhsflat = ', rhsflat.shape)
 
-        # Associate to all mesh nodes a line number in the system matrix
-        # reserving top lines for internal nodes and bottom lines for fixed nodes (boundary nodes).
-        node2unknown = np.zeros(maxNodeTag+1, dtype=np.int32)
-        index = 0
-        for tagNode,typ in enumerate(typNodes):
-            if  typ == 1: # not fixed
-                index += 1
-                node2unknown[tagNode] = index
-        numUnknowns = index
-        printf('numUnknowns =', numUnknowns)
-        for tagNode,typ in enumerate(typNodes):
-            if  typ == 2: # fixed
-                index += 1
-                node2unknown[tagNode] = index
-
-        if index != numMeshNodes:
-            errorf('Something went wrong')
-
-        unknown2node = np.zeros(numMeshNodes+1, dtype=np.int32)
-        for node, unkn in enumerate(node2unknown):
-            unknown2node[unkn] = node
-
-        printf('\nDimension of nodes vs unknowns arrays')
-        printf('%mshNodes=',mshNodes.shape)
-        printf('%typNodes=',typNodes.shape)
-        printf('%node2unknown=',node2unknown.shape)
-        printf('%unknown2node=',unknown2node.shape)
-
         # Generate system matrix A=globalmat and right hand side b=globalrhs
 
-        # https://docs.scipy.org/doc/scipy/reference/generated/scipy.sparse.coo_matrix.html
         # 'node2unknown-1' are because python numbers rows and columns from 0
-        globalmat = scipy.sparse.coo_matrix(
-            (matflat, (node2unknown[matcolflat.astype(int)]-1, node2unknown[matrowflat.astype(int)]-1) ),
-            shape=(numMeshNodes, numMeshNodes)).todense()
+        # This index map is computed once and shared by the matrix and the right hand side.
+        node2row = node2unknown.astype(int) - 1
+
+        # The matrix is kept sparse (CSR) : since node2unknown puts the internal nodes first,
+        # the system to solve is the upper-left block of the global matrix,
+        # so only the triplets coupling two internal nodes are kept.
+        unknownrow = node2row[matcolflat]
+        unknowncol = node2row[matrowflat]
+        internal = np.logical_and(unknownrow < numUnknowns, unknowncol < numUnknowns)
+        sBlocks, iA, jA = COOtoCSR(unknownrow[internal], unknowncol[internal], matflat[internal], numUnknowns)
 
-        globalrhs = np.zeros(numMeshNodes)
-        for index,node in enumerate(rhsrowflat):
-            globalrhs[node2unknown[int(node)]-1] += rhsflat[int(index)]
+        globalrhs = scatter_add(node2row[rhsrowflat], rhsflat, numMeshNodes)
 
-        printf('%globalmat =', globalmat.shape, ' %globalrhs =', globalrhs.shape)
+        printf('%sBlocks =', sBlocks.shape, ' %globalrhs =', globalrhs.shape)
 
-        A = globalmat[:numUnknowns,:numUnknowns]
-        b = globalrhs[:numUnknowns]
+        return {'sBlocks': sBlocks, 'iA': iA, 'jA': jA, 'rhs': globalrhs[:numUnknowns],
+                'numMeshNodes': numMeshNodes, 'numUnknowns': numUnknowns, 'unknown2node': unknown2node}
+
+    def system_matrix(assembly, freq, vel, mur):
+        # Cheap linear combination of the blocks computed once by assemble()
+        jomega = complex(0, 2 * np.pi * freq)
+        coefs = np.array([1/mu0, 1/(mur*mu0), sigma*jomega, sigma*vel], dtype=complex)
+        if freq == 0:
+            coefs = coefs.real # the static system is real
+        sA = np.dot(assembly['sBlocks'], coefs)
+        N = assembly['numUnknowns']
+        return scipy.sparse.csr_matrix((sA, assembly['jA'], assembly['iA']), shape=(N, N))
+
+    def solve(mesh, freq, vel, mur, SolverType, rtol, prec, export):
+        # The blocks only depend on the mesh : they are assembled once
+        # and every later call with other freq, vel or mur only recombines them.
+        if 'assembly' not in mesh:
+            mesh['assembly'] = assemble(mesh)
+        assembly = mesh['assembly']
+        numMeshNodes = assembly['numMeshNodes']
+        numUnknowns = assembly['numUnknowns']
+        unknown2node = assembly['unknown2node']
+
+        A = system_matrix(assembly, freq, vel, mur)
+        b = assembly['rhs'].copy()
+        # Kair, Kcore and Mplate are symmetric, Cplate is not : the structure of A is known without looking at it
+        if freq == 0 and vel == 0:
+            structure = 'spd'
+        elif vel == 0:
+            structure = 'symmetric'
+        else:
+            structure = None
+        printf('%globalmat =', A.shape, ' %globalrhs =', b.shape)
         if copy:
             A2 = A.copy()
             b2 = b.copy()
@@ -336,7 +710,7 @@ def ndtfun(gap, ref, freq, vel, mur, run, copy, SolverType, rtol, prec):
             A2 = A
             b2 = b
         tic = time.time()
-        success, x = mysolve(A, b) # , SolverType, rtol, prec)
+        success, x = mysolve(A, b, structure) # , SolverType, rtol, prec)
         toc = time.time()
         print(toc-tic)
         if not success:
@@ -344,32 +718,54 @@ def ndtfun(gap, ref, freq, vel, mur, run, copy, SolverType, rtol, prec):
         sol = np.append(x,np.zeros(numMeshNodes-numUnknowns))
         printf('%sol =', sol.shape)
 
-        # Export solution
-        sview = gmsh.view.add("solution")
-        gmsh.view.addModelData(sview,0,"","NodeData",unknown2node[1:],sol[:,None])
-        # gmsh.view.write(sview,"a.pos")
+        # Export solution (only when the mesh was generated by gmsh in this call)
+        if export:
+            sview = gmsh.view.add("solution")
+            gmsh.view.addModelData(sview,0,"","NodeData",unknown2node[1:],sol[:,None])
+            # gmsh.view.write(sview,"a.pos")
         printf('Flux (computed) =', np.max(sol)-np.min(sol))
 
         return A2, b2, numMeshNodes, x, toc-tic
 
     model = gmsh.model
     factory = model.geo
-    gmsh.initialize(sys.argv)
 
-    # gmsh.option.setNumber("Mesh.CharacteristicLengthFactor", ref)
-    gmsh.option.setNumber("General.Terminal", 1)
-    gmsh.option.setNumber("View[0].IntervalsType", 3)
-    gmsh.option.setNumber("View[0].NbIso", 20)
+    # gmsh only has to mesh the geometry if it was not meshed before (or to display the solution)
+    key = (gap, ref) if msh is None else os.path.abspath(msh)
+    mesh = cached_mesh(key)
+    if mesh is None and msh is not None:
+        mesh = store_mesh(key, read_msh(msh, Integration))
+    meshed = mesh is None or run
+    if meshed:
+        gmsh.initialize(sys.argv)
+
+        # gmsh.option.setNumber("Mesh.CharacteristicLengthFactor", ref)
+        gmsh.option.setNumber("General.Terminal", 1)
+        gmsh.option.setNumber("View[0].IntervalsType", 3)
+        gmsh.option.setNumber("View[0].NbIso", 20)
+
+        if msh is None:
+            create_geometry(gap, ref)
+            model.mesh.generate(2)
+        else:
+            gmsh.open(msh)
+        if mesh is None:
+            mesh = store_mesh(key, read_mesh(Integration))
+    A2, b, num_nodes, sol, tictoc = solve(mesh, freq, vel, mur, SolverType, rtol, prec, meshed)
 
-    create_geometry(gap, ref)
-    model.mesh.generate(2)
-    A2, b, num_nodes, sol, tictoc = solve(freq, vel, mur, SolverType, rtol, prec)
+    # the mesh, now numbered, is saved once as a snapshot
+    if snapshot_path(key) is not None and not has_snapshot(key):
+        if isinstance(key, tuple):
+            os.makedirs(MESH_CACHE_DIR, exist_ok=True)
+        save_snapshot(snapshot_path(key), mesh)
 
     # gmsh.write('ndt.msh')
     if run:
         gmsh.fltk.run()
 
-    return A2, b, num_nodes, sol, np.linalg.cond(A2), tictoc
+    # the condition number needs the dense matrix, it is only computed on small meshes
+    cond = np.linalg.cond(A2.toarray()) if COND and A2.shape[0] <= COND_MAX_N else None
+    return A2, b, num_nodes, sol, cond, tictoc
 
 
 
@@ -41,15 +41,15 @@ def test_solve():
 def plot_eig():
     A, b, num_nodes, sol, cond, tictoc = ndtfun(0.2, 1, 50, 0, 100., run=False, copy=True, SolverType='GMRES', rtol=1e-7, prec=True)
     A2 = A.copy()
-    LUres= ILU0_slow(np.array(A))
+    LUres= ILU0_slow(A.toarray())
     U = np.triu(LUres)
     L = np.eye(len(LUres), dtype=complex) + LUres - U
-    M = L.conjugate() @ U
+    M = L @ U
     Minv = np.linalg.inv(M)
 
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(4, 7))
 
-    s = np.linalg.eigvals(A2)
+    s = np.linalg.eigvals(A2.toarray())
 
     ticks_x = ticker.FuncFormatter(lambda x, pos: '{:5.1e}'.format(x))
     ax1.xaxis.set_major_formatter(ticks_x)
@@ -159,9 +159,9 @@ def plot_prec_iter():
         A, b, num_nodes, sol, cond, tictoc = ndtfun(0.2, 1, 50, 1, 100., run=False, copy=True, SolverType='numpy',
                                                     rtol=1e-7, prec=False)
         b = b.copy()
-        sA, iA, jA = CSRformat(np.array(A))
+        sA, iA, jA = CSRformat(A)
         u, res = csrGMRES(sA, iA, jA, np.array(b), rtol=1e-14, prec=True, max_iter=n)
-        prec.append(np.linalg.norm(np.dot(A, u) - b)/np.linalg.norm(b))
+        prec.append(np.linalg.norm(A @ u - b)/np.linalg.norm(b))
         iter.append(len(res))
 
     prec = np.array(prec)
@@ -174,9 +174,9 @@ def plot_prec_iter():
         A, b, num_nodes, sol, cond, tictoc = ndtfun(0.2, 1, 50, 1, 100., run=False, copy=True, SolverType='numpy',
                                                     rtol=1e-7, prec=False)
         b = b.copy()
-        sA, iA, jA = CSRformat(np.array(A))
+        sA, iA, jA = CSRformat(A)
         u, res = csrGMRES(sA, iA, jA, np.array(b), rtol=1e-7, prec=False, max_iter=n)
-        prec.append(np.linalg.norm(np.dot(A, u) - b)/np.linalg.norm(b))
+        prec.append(np.linalg.norm(A @ u - b)/np.linalg.norm(b))
         iter.append(len(res))
 
     prec = np.array(prec)
@@ -201,7 +201,7 @@ def get_iter_prec(rtol, prec, ref, max_iter):
                                                 rtol=1e-7, prec=prec)
     sA, iA, jA = CSRformat(A)
     u, res = csrGMRES(sA, iA, jA, np.array(b), rtol, prec, max_iter=max_iter)
-    precision.append(np.linalg.norm(np.dot(A, u) - b)/np.linalg.norm(b))
+    precision.append(np.linalg.norm(A @ u - b)/np.linalg.norm(b))
     niter.append(len(res))
 
     # STATIONNAIRE
@@ -209,7 +209,7 @@ def get_iter_prec(rtol, prec, ref, max_iter):
                                                 rtol=1e-7, prec=prec)
     sA, iA, jA = CSRformat(A)
     u, res = csrGMRES(sA, iA, jA, np.array(b), rtol, prec, max_iter=max_iter)
-    precision.append(np.linalg.norm(np.dot(A, u) - b)/np.linalg.norm(b))
+    precision.append(np.linalg.norm(A @ u - b)/np.linalg.norm(b))
     niter.append(len(res))
 
     # HARMONIQUE
@@ -217,7 +217,7 @@ def get_iter_prec(rtol, prec, ref, max_iter):
                                                 rtol=1e-7, prec=prec)
     sA, iA, jA = CSRformat(A)
     u, res = csrGMRES(sA, iA, jA, np.array(b), rtol, prec, max_iter=max_iter)
-    precision.append(np.linalg.norm(np.dot(A, u) - b)/np.linalg.norm(b))
+    precision.append(np.linalg.norm(A @ u - b)/np.linalg.norm(b))
     niter.append(len(res))
 
     # DYNAMIQUE
@@ -225,7 +225,7 @@ def get_iter_prec(rtol, prec, ref, max_iter):
                                                 rtol=1e-7, prec=prec)
     sA, iA, jA = CSRformat(A)
     u, res = csrGMRES(sA, iA, jA, np.array(b), rtol, prec, max_iter=max_iter)
-    precision.append(np.linalg.norm(np.dot(A, u) - b)/np.linalg.norm(b))
+    precision.append(np.linalg.norm(A @ u - b)/np.linalg.norm(b))
     niter.append(len(res))
 
     print(precision)